@@ -0,0 +1,57 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+tf.enable_eager_execution()
+
+
+def _stats(times):
+    times = np.asarray(times) * 1000
+    return {'mean': float(np.mean(times)), 'p50': float(np.percentile(times, 50)),
+            'p99': float(np.percentile(times, 99))}
+
+
+def run(dataset, step_fn, warmup=10, steps=50, after_step=None):
+    """
+        time warmup + steps train steps, next() on the iterator is timed separately from the step
+    :param step_fn: step_fn(*batch) -> tuple of tensors, the first one is read back to wait for the step
+    :param after_step: called after each step, counted as compute (e.g. applying accumulated gradients)
+    :return: dict of images/sec, step/input/compute ms (mean, p50, p99)
+    """
+    iterator = iter(dataset.repeat())
+    input_times = []
+    compute_times = []
+    images = 0
+    for i in range(warmup + steps):
+        start = time.time()
+        batch = next(iterator)
+        fetched = time.time()
+        outputs = step_fn(*batch)
+        if after_step is not None:
+            after_step()
+        tf.nest.flatten(outputs)[0].numpy()    # the step is done once its loss is on the host
+        done = time.time()
+        if i >= warmup:
+            input_times.append(fetched - start)
+            compute_times.append(done - fetched)
+            images += int(batch[0].shape[0])
+    step_times = np.asarray(input_times) + np.asarray(compute_times)
+    total = float(np.sum(step_times))
+    return {'images_per_sec': images / total, 'steps_per_sec': steps / total, 'images_per_step': images / steps,
+            'step_ms': _stats(step_times), 'input_ms': _stats(input_times), 'compute_ms': _stats(compute_times),
+            'input_fraction': float(np.sum(input_times)) / total}
+
+
+def report(result, output=None):
+    """
+        print the result as one json line, and append it to output if set
+    """
+    line = json.dumps(result, sort_keys=True)
+    print(line)
+    if output:
+        with open(output, 'a') as f:
+            f.write(line + '\n')
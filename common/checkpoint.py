@@ -0,0 +1,185 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import glob
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+
+import tensorflow as tf
+
+tf.enable_eager_execution()
+
+
+class AsyncCheckpointer:
+    """
+        checkpoints written off the training thread
+        1. save() snapshots the variables with ckpt.write() into a local staging dir (tmpfs if there is one),
+           training only waits for this local write
+        2. a background thread copies the snapshot into ckpt_dir, then updates the checkpoint state file
+           and deletes the checkpoints above max_to_keep, so ckpt_dir never points at a partial checkpoint
+        the tf.data iterator can be saved next to each checkpoint, to resume in the middle of an epoch
+    """
+
+    def __init__(self, ckpt, ckpt_dir, max_to_keep=5, checkpoint_name='mymodel', staging_dir=None,
+                 save_iterator=True):
+        """
+        :param ckpt: tf.train.Checkpoint
+        :param ckpt_dir:
+        :param max_to_keep:
+        :param checkpoint_name: checkpoints are <ckpt_dir>/<checkpoint_name>-<global step>
+        :param staging_dir: dir of the snapshots, default /dev/shm if it exists, else the system temp dir
+        :param save_iterator: save the iterator passed to save(), turned off if the dataset can not be saved
+        """
+        self.ckpt = ckpt
+        self.ckpt_dir = os.path.expanduser(ckpt_dir)
+        if not os.path.exists(self.ckpt_dir):
+            os.makedirs(self.ckpt_dir)
+        self.max_to_keep = max_to_keep
+        self.checkpoint_name = checkpoint_name
+        if not staging_dir:
+            staging_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.staging_dir = tempfile.mkdtemp(prefix='ckpt_', dir=os.path.expanduser(staging_dir))
+        self.save_iterator = save_iterator
+
+        state = tf.train.get_checkpoint_state(self.ckpt_dir)
+        self.checkpoints = list(state.all_model_checkpoint_paths) if state is not None else []
+        # one snapshot in flight at most, a second save waits for the copy of the first one
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    @property
+    def latest_checkpoint(self):
+        return tf.train.latest_checkpoint(self.ckpt_dir)
+
+    def save(self, global_step, iterator=None):
+        """
+        :param global_step: python int, checkpoint number
+        :param iterator: iterator of the current epoch, None at an epoch boundary
+        :return: path the checkpoint will have in ckpt_dir
+        """
+        name = '{}-{}'.format(self.checkpoint_name, global_step)
+        # a stage dir per save, a second save at the same step must not touch a snapshot still being copied
+        stage = tempfile.mkdtemp(prefix=name + '_', dir=self.staging_dir)
+        self.ckpt.write(os.path.join(stage, name))
+        if iterator is not None and self.save_iterator:
+            try:
+                tf.train.Checkpoint(iterator=iterator).write(os.path.join(stage, name + '_iterator'))
+            except (tf.errors.OpError, ValueError, TypeError) as e:
+                # e.g. from_generator or numpy_function datasets, restore falls back to skipping steps
+                print('Can not save the dataset iterator, a mid-epoch resume will only be approximate: {}'.format(e))
+                self.save_iterator = False
+        self.queue.put((stage, name))
+        return os.path.join(self.ckpt_dir, name)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            stage, name = item
+            try:
+                path = os.path.join(self.ckpt_dir, name)
+                if path in self.checkpoints:
+                    self._remove(path)
+                for stage_path in glob.glob(os.path.join(stage, name + '*')):
+                    shutil.copy(stage_path, self.ckpt_dir)
+                self.checkpoints.append(path)
+                for old in self.checkpoints[:-self.max_to_keep]:
+                    for old_path in glob.glob(old + '.*') + glob.glob(old + '_iterator.*'):
+                        os.remove(old_path)
+                self.checkpoints = self.checkpoints[-self.max_to_keep:]
+                tf.compat.v1.train.update_checkpoint_state(self.ckpt_dir, path, self.checkpoints)
+            except Exception as e:
+                print('Failed to save checkpoint {}: {}'.format(name, e))
+            finally:
+                shutil.rmtree(stage, ignore_errors=True)
+                self.queue.task_done()
+
+    def _remove(self, path):
+        """
+            a second save at the same step (e.g. ckpt_steps and the end of the epoch) replaces the first one:
+            the state file stops pointing at it before its files, a stale iterator state included, are deleted
+        """
+        self.checkpoints.remove(path)
+        if self.checkpoints:
+            tf.compat.v1.train.update_checkpoint_state(self.ckpt_dir, self.checkpoints[-1], self.checkpoints)
+        elif os.path.exists(os.path.join(self.ckpt_dir, 'checkpoint')):
+            os.remove(os.path.join(self.ckpt_dir, 'checkpoint'))
+        for old_path in glob.glob(path + '.*') + glob.glob(path + '_iterator.*'):
+            os.remove(old_path)
+
+    def wait(self):
+        """
+            block until every snapshot is copied into ckpt_dir
+        """
+        self.queue.join()
+
+    def restore_iterator(self, iterator, ckpt_path=None):
+        """
+        :return: True if the iterator state saved with the checkpoint was restored
+        """
+        ckpt_path = ckpt_path or self.latest_checkpoint
+        if ckpt_path is None or not os.path.exists(ckpt_path + '_iterator.index'):
+            return False
+        tf.train.Checkpoint(iterator=iterator).restore(ckpt_path + '_iterator')
+        return True
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+class PreemptionFlag:
+    """
+        SIGTERM / SIGINT received while a train step runs (inside deferred()) only set a flag,
+        the train loop checks it after the step, writes a final checkpoint and stops.
+        outside a step (validation, triplet mining, the final save) the previous handlers run as usual.
+        use it as a context manager around the train loop, the previous handlers are restored on exit
+    """
+
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        self.signals = signals
+        self.triggered = False
+        self.deferring = False
+        self.previous = {}
+
+    def __enter__(self):
+        for sig in self.signals:
+            self.previous[sig] = signal.signal(sig, self._handler)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for sig, handler in self.previous.items():
+            signal.signal(sig, handler if handler is not None else signal.SIG_DFL)
+        self.previous = {}
+        return False
+
+    @contextlib.contextmanager
+    def deferred(self):
+        self.deferring = True
+        try:
+            yield
+        finally:
+            self.deferring = False
+
+    def _handler(self, signum, frame):
+        if self.deferring:
+            print('Received signal {}, saving a checkpoint after this step'.format(signum))
+            self.triggered = True
+            return
+        previous = self.previous.get(signum)
+        if callable(previous):
+            # e.g. the default SIGINT handler, raises KeyboardInterrupt
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # default action (e.g. terminate on SIGTERM): reinstall it and send the signal again
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
@@ -0,0 +1,226 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+tf.enable_eager_execution()
+
+PRECISIONS = ('float32', 'bfloat16', 'float16')
+
+
+def set_policy(precision='float32'):
+    """
+        global keras mixed precision policy, call it before the model is built:
+        layers compute in precision, variables stay float32
+    :return: compute dtype, inputs of the model should be cast to it
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Invalid precision')
+    mixed_precision = tf.keras.mixed_precision.experimental
+    if precision == 'float32':
+        mixed_precision.set_policy('float32')
+        return tf.float32
+    try:
+        mixed_precision.set_policy('mixed_' + precision)
+    except (ValueError, TypeError):
+        # older keras: layers compute in the dtype of their inputs, float32 variables are cast when read
+        mixed_precision.set_policy('infer_float32_vars')
+    compute_dtype = tf.as_dtype(precision)
+    _check_policy(compute_dtype)
+    return compute_dtype
+
+
+def _check_policy(compute_dtype):
+    """
+        a layer fed compute_dtype inputs must compute in compute_dtype and keep float32 variables,
+        else the policy silently did not take effect (e.g. a keras version without either policy)
+    """
+    layer = tf.keras.layers.Dense(1)
+    outputs = layer(tf.zeros((1, 1), dtype=compute_dtype))
+    var_dtype = tf.as_dtype(getattr(layer.kernel, 'true_dtype', layer.kernel.dtype))
+    if outputs.dtype != compute_dtype or var_dtype != tf.float32:
+        policy = tf.keras.mixed_precision.experimental.global_policy()
+        tf.keras.mixed_precision.experimental.set_policy('float32')
+        raise RuntimeError('Mixed precision policy {} did not take effect with TF {}: layers compute in {} with {} '
+                           'variables, expected {} with float32 variables'.format(
+                               policy.name, tf.__version__, outputs.dtype.name, var_dtype.name, compute_dtype.name))
+
+
+class LossScale:
+    """
+        dynamic loss scaling for float16, whose small exponent range underflows small gradients
+        (bfloat16 has the float32 exponent range and needs none)
+        the loss is multiplied by scale before the backward pass and the gradients are divided by it again,
+        a step with non finite gradients is skipped and halves the scale, growth_interval finite steps double it
+    """
+
+    def __init__(self, initial_scale=2 ** 15, growth_interval=2000):
+        self.scale = tf.Variable(float(initial_scale), trainable=False)
+        self.good_steps = tf.Variable(0, trainable=False)
+        self.growth_interval = growth_interval
+
+    def scale_loss(self, loss):
+        """
+            call it inside the tape, or pass self.scale as output_gradients of tape.gradient instead
+        """
+        return loss * self.scale
+
+    def unscale(self, gradients):
+        """
+        :return: unscaled gradients, whether all of them are finite
+        """
+        gradients = [g / self.scale if g is not None else None for g in gradients]
+        finite = tf.reduce_all([tf.reduce_all(tf.math.is_finite(g)) for g in gradients if g is not None])
+        return gradients, finite
+
+    def update(self, finite):
+        grow = tf.logical_and(finite, self.good_steps + 1 >= self.growth_interval)
+        new_scale = tf.where(finite, tf.where(grow, self.scale * 2, self.scale), tf.maximum(self.scale / 2, 1.0))
+        new_good_steps = tf.where(tf.logical_and(finite, tf.logical_not(grow)), self.good_steps + 1, 0)
+        self.scale.assign(new_scale)
+        self.good_steps.assign(new_good_steps)
+
+
+def _create_slots(optimizer, gradients, variables):
+    """
+        create the optimizer slots (and iterations, hyper parameters) of the variables with a gradient
+        outside of the tf.function, the first apply_gradients would else create them inside a cond branch
+    """
+    var_list = [var for g, var in zip(gradients, variables) if g is not None]
+    with tf.init_scope():
+        _ = optimizer.iterations
+        optimizer._create_hypers()
+        optimizer._create_slots(var_list)
+
+
+def apply_gradients(optimizer, gradients, variables, loss_scale=None):
+    """
+        optimizer.apply_gradients, with the loss scale removed and non finite steps skipped if loss_scale is set
+    """
+    if loss_scale is None:
+        optimizer.apply_gradients(zip(gradients, variables))
+        return
+
+    gradients, finite = loss_scale.unscale(gradients)
+    _create_slots(optimizer, gradients, variables)
+
+    def apply_fn():
+        with tf.control_dependencies([optimizer.apply_gradients(zip(gradients, variables))]):
+            return tf.constant(True)
+
+    tf.cond(finite, apply_fn, lambda: tf.constant(False))
+    loss_scale.update(finite)
+
+
+def _recognition_task(compute_dtype, batch_size):
+    """
+    :return: model, step inputs, infer_fn(model, *inputs), loss_fn(model, *inputs) (arcface loss)
+    """
+    from recognition.backbones.resnet_v1 import ResNet_v1_50
+    from recognition.losses.loss import arcface_loss
+    from recognition.models.models import MyModel
+
+    classes = 1000
+    model = MyModel(ResNet_v1_50, embedding_size=512, classes=classes, compute_dtype=compute_dtype)
+    images = tf.random.uniform((batch_size, 112, 112, 3))
+    labels = tf.constant(np.random.randint(classes, size=batch_size), dtype=tf.int32)
+
+    def infer_fn(m, img, label):
+        prelogits, _, _ = m(img, training=False)
+        return prelogits
+
+    def loss_fn(m, img, label):
+        prelogits, _, norm_dense = m(img, training=True)
+        return arcface_loss(prelogits, norm_dense, label, 1.0, 0.2, 0.3, 64.0)
+
+    return model, (images, labels), infer_fn, loss_fn
+
+
+def _retinaface_task(compute_dtype, batch_size):
+    """
+        the loss is a surrogate (mean of the outputs), anchor matching in LossUtil runs in numpy
+        and does not depend on the precision
+    """
+    from retinaface.backbones.resnet_v1_fpn import ResNet_v1_50_FPN
+    from retinaface.models.models import RetinaFace
+
+    model = RetinaFace(ResNet_v1_50_FPN, num_class=2, anchor_per_scale=6, compute_dtype=compute_dtype)
+    images = tf.random.uniform((batch_size, 640, 640, 3))
+
+    def infer_fn(m, img):
+        cls, box, lmk = m(img, training=False)
+        return cls[0]
+
+    def loss_fn(m, img):
+        cls, box, lmk = m(img, training=True)
+        return tf.add_n([tf.reduce_mean(y) for y in cls + box + lmk])
+
+    return model, (images,), infer_fn, loss_fn
+
+
+TASKS = {'recognition': (_recognition_task, 64), 'retinaface': (_retinaface_task, 4)}
+
+
+def benchmark(precision, task='recognition', batch_size=None, steps=20):
+    """
+        images/sec of inference and of a train step with the given precision
+    :param task: recognition (ResNet_v1_50, 112x112, arcface) or retinaface (ResNet_v1_50_FPN, 640x640)
+    :param batch_size: None for the task default
+    """
+    build_fn, default_batch_size = TASKS[task]
+    batch_size = batch_size or default_batch_size
+    compute_dtype = set_policy(precision)
+    model, inputs, infer_fn, loss_fn = build_fn(compute_dtype, batch_size)
+    optimizer = tf.keras.optimizers.SGD(0.01)
+    loss_scale = LossScale() if precision == 'float16' else None
+
+    @tf.function
+    def infer_step(*args):
+        return infer_fn(model, *args)
+
+    @tf.function
+    def train_step(*args):
+        with tf.GradientTape() as tape:
+            loss = loss_fn(model, *args)
+            scaled_loss = loss_scale.scale_loss(loss) if loss_scale is not None else loss
+        gradients = tape.gradient(scaled_loss, model.trainable_variables)
+        apply_gradients(optimizer, gradients, model.trainable_variables, loss_scale)
+        return loss
+
+    results = {}
+    for name, fn in (('infer', infer_step), ('train', train_step)):
+        fn(*inputs).numpy()   # trace and warm up
+        start = time.time()
+        for _ in range(steps):
+            fn(*inputs).numpy()
+        results[name] = batch_size * steps / (time.time() - start)
+    set_policy('float32')
+    return results
+
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Mixed precision throughput.')
+    parser.add_argument('--precision', type=str, nargs='*', choices=PRECISIONS, default=['float32', 'bfloat16'])
+    parser.add_argument('--task', type=str, choices=sorted(TASKS.keys()), default='recognition')
+    parser.add_argument('--batch_size', type=int, default=None, help='default 64 for recognition, 4 for retinaface')
+    parser.add_argument('--steps', type=int, default=20)
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main():
+    import sys
+    args = parse_args(sys.argv[1:])
+    print('{:<12}{:>16}{:>16}'.format('precision', 'infer images/s', 'train images/s'))
+    for precision in args.precision:
+        results = benchmark(precision, args.task, args.batch_size, args.steps)
+        print('{:<12}{:>16.1f}{:>16.1f}'.format(precision, results['infer'], results['train']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import tensorflow as tf
+
+from common.checkpoint import AsyncCheckpointer
+from common.precision import apply_gradients
+
+tf.enable_eager_execution()
+
+
+class GradientAccumulator:
+    """
+        gradients of accum_steps micro batches averaged into one optimizer step,
+        with accum_steps 1 the gradients of every batch are applied right away
+        variables without a gradient are left out of the update (no optimizer slots for them):
+        1. the unused variables passed to build() get no accumulator
+        2. when add() runs eagerly, a variable is only updated if a micro batch of the window gave it a gradient,
+           the loss may leave some heads without a gradient for a batch
+    """
+
+    def __init__(self, optimizer, accum_steps=1, loss_scale=None):
+        """
+        :param optimizer:
+        :param accum_steps: micro batches per optimizer step
+        :param loss_scale: LossScale with float16, None else
+        """
+        self.optimizer = optimizer
+        self.accum_steps = max(accum_steps, 1)
+        self.loss_scale = loss_scale
+        self.variables = None
+        self.accum_grads = None
+        self.used = None
+        self.window_mask = None
+        self.pending = 0
+
+    def build(self, variables, unused=()):
+        """
+        :param variables: trainable variables of the model, built, in the order of the gradients passed to add()
+        :param unused: variables no loss gives a gradient
+        """
+        self.variables = list(variables)
+        unused = set(id(var) for var in unused)
+        self.used = [id(var) not in unused for var in self.variables]
+        if self.accum_steps > 1:
+            self.accum_grads = [tf.Variable(tf.zeros_like(var), trainable=False) if used else None
+                                for var, used in zip(self.variables, self.used)]
+
+    def add(self, gradients):
+        """
+            apply the gradients, or add 1/accum_steps of them to the accumulators,
+            inside a compiled train step or eagerly
+        """
+        if self.accum_steps == 1:
+            apply_gradients(self.optimizer, gradients, self.variables, self.loss_scale)
+            return
+        if tf.executing_eagerly():
+            mask = self.window_mask or [False] * len(gradients)
+            self.window_mask = [m or g is not None for m, g in zip(mask, gradients)]
+        self._accumulate(gradients)
+
+    @tf.function
+    def _accumulate(self, gradients):
+        for accum, g in zip(self.accum_grads, gradients):
+            if accum is not None and g is not None:
+                accum.assign_add(g / self.accum_steps)
+
+    @tf.function
+    def _apply_accumulated(self, scale, mask):
+        """
+        :param scale: accum_steps / accumulated micro batches, 1 for a full accumulation
+        :param mask: tuple of python bools, variables updated by this step (part of the trace key)
+        """
+        gradients = [accum * scale if has_grad else None for accum, has_grad in zip(self.accum_grads, mask)]
+        apply_gradients(self.optimizer, gradients, self.variables, self.loss_scale)
+        for accum, has_grad in zip(self.accum_grads, mask):
+            if has_grad:
+                accum.assign(tf.zeros_like(accum))
+
+    def step(self):
+        """
+            count a micro batch after its train step, the accumulated gradients are applied every accum_steps
+        """
+        if self.accum_steps > 1:
+            self.pending += 1
+            if self.pending == self.accum_steps:
+                self.flush()
+
+    def flush(self):
+        """
+            apply the gradients accumulated so far, e.g. the last micro batches of an epoch
+        """
+        if self.pending > 0:
+            mask = self.used
+            if self.window_mask is not None:
+                mask = [used and has_grad for used, has_grad in zip(self.used, self.window_mask)]
+            self._apply_accumulated(tf.constant(self.accum_steps / self.pending, dtype=tf.float32), tuple(mask))
+            self.pending = 0
+            self.window_mask = None
+
+
+class TrainLoop:
+    """
+        epochs of train steps with checkpoints that can be resumed
+        1. global step, epoch and step in the epoch are saved with each checkpoint, so a restored run
+           continues its summaries and resumes in the middle of an epoch
+        2. a checkpoint every ckpt_steps steps, on an optimizer step boundary (the accumulators are not saved),
+           and one at the start of each epoch, written by an AsyncCheckpointer
+        3. SIGTERM / SIGINT during a step (PreemptionFlag) write a final checkpoint and stop the run
+    """
+
+    def __init__(self, ckpt_items, ckpt_dir, accumulator, ckpt_steps=0, staging_dir=None, save_iterator=True):
+        """
+        :param ckpt_items: dict of the checkpointed objects, e.g. model and optimizer, restored if there is
+                           a checkpoint in ckpt_dir
+        :param ckpt_dir:
+        :param accumulator: GradientAccumulator of the train steps
+        :param ckpt_steps: checkpoint every ckpt_steps steps, 0 for the epoch checkpoints only
+        :param staging_dir: see AsyncCheckpointer
+        :param save_iterator: see AsyncCheckpointer
+        """
+        self.accumulator = accumulator
+        self.ckpt_steps = ckpt_steps
+        self.ckpt_due = False
+        # steps over all epochs, saved with the checkpoint so summaries continue after a restore
+        self.global_step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        # position in the epoch, to resume in the middle of an epoch
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.epoch_step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.ckpt = tf.train.Checkpoint(global_step=self.global_step, epoch=self.epoch, epoch_step=self.epoch_step,
+                                        **ckpt_items)
+        self.checkpointer = AsyncCheckpointer(self.ckpt, ckpt_dir, max_to_keep=5, checkpoint_name='mymodel',
+                                              staging_dir=staging_dir, save_iterator=save_iterator)
+
+        if self.checkpointer.latest_checkpoint:
+            self.ckpt.restore(self.checkpointer.latest_checkpoint)
+            print("Restored from {}".format(self.checkpointer.latest_checkpoint))
+        else:
+            print("Initializing from scratch.")
+        # python copy of global_step, no host sync per step
+        self.step = int(self.global_step.numpy())
+
+    def epochs(self, epoch_num):
+        """
+            epochs left, the first one resumes at the restored step in the epoch
+        """
+        return range(int(self.epoch.numpy()), epoch_num)
+
+    def _get_iterator(self, dataset, restore=True):
+        """
+            iterator of this epoch. resuming mid-epoch is exact if the iterator state saved with the checkpoint
+            is restored, else the first batches of the rebuilt (reshuffled) dataset are skipped:
+            some samples of the epoch are then seen twice and others not at all
+        :param restore: False if dataset is not the one the iterator state was saved for
+        """
+        skip = int(self.epoch_step.numpy())
+        iterator = iter(dataset)
+        if skip <= 0:
+            return iterator
+        if restore and self.checkpointer.restore_iterator(iterator):
+            print('Resuming at step {} of epoch {} from the saved iterator state'.format(skip, int(self.epoch.numpy())))
+        else:
+            iterator = iter(dataset.skip(skip))
+            print('Resuming approximately at step {} of epoch {}: no saved iterator state for this dataset, '
+                  'skipping {} batches of a reshuffled dataset'.format(skip, int(self.epoch.numpy()), skip))
+        return iterator
+
+    def _end_step(self, iterator, preemption):
+        """
+        :return: True if preempted, a final checkpoint is written before
+        """
+        self.global_step.assign_add(1)
+        self.epoch_step.assign_add(1)
+        self.accumulator.step()
+        if preemption.triggered:
+            self.accumulator.flush()
+            save_path = self.checkpointer.save(self.step, iterator)
+            self.checkpointer.wait()
+            print('Saved checkpoint at {} before stopping'.format(save_path))
+            return True
+        if self.ckpt_steps > 0 and self.step % self.ckpt_steps == 0:
+            self.ckpt_due = True
+        # the accumulators are not in the checkpoint, save between two optimizer steps only
+        if self.ckpt_due and self.accumulator.pending == 0:
+            self.checkpointer.save(self.step, iterator)
+            self.ckpt_due = False
+        return False
+
+    def run_epoch(self, epoch, dataset, step_fn, metrics, preemption, restore=True):
+        """
+            the train steps of one epoch, resumed if the checkpoint was saved in the middle of it
+        :param dataset: batches of this epoch, None if there is nothing to train on (e.g. no triplets mined)
+        :param step_fn: step_fn(*batch) -> tuple of the values recorded in metrics
+        :param metrics: TrainMetrics
+        :param preemption: PreemptionFlag, entered
+        :param restore: False if dataset is not the one the iterator state was saved for
+        :return: True if preempted, a final checkpoint is written before
+        """
+        self.epoch.assign(epoch)
+        preempted = False
+        if dataset is not None:
+            iterator = self._get_iterator(dataset, restore)
+            for batch in metrics.timed(iterator):
+                with preemption.deferred():
+                    values = step_fn(*batch)
+                    self.step += 1
+                    metrics.record(values, self.step)
+                    preempted = self._end_step(iterator, preemption)
+                if preempted:
+                    break
+        # the last micro batches of the epoch, accumulators are not saved in the checkpoints
+        self.accumulator.flush()
+        metrics.flush(self.step)
+        return preempted
+
+    def end_epoch(self, epoch):
+        """
+            checkpoint at the start of the next epoch
+        :return: path the checkpoint will have in ckpt_dir
+        """
+        self.epoch.assign(epoch + 1)
+        self.epoch_step.assign(0)
+        return self.checkpointer.save(self.step)
+
+    def close(self):
+        self.checkpointer.close()
@@ -0,0 +1,111 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import queue
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+tf.enable_eager_execution()
+
+
+class TrainMetrics:
+    """
+        aggregated training metrics without a host sync per step
+        1. record() writes the step losses into a row of an on-device ring buffer
+        2. every flush_steps steps a snapshot of the buffer is handed to a background thread, which reads it
+           (the only sync), computes mean and percentiles and writes the summaries and one log line
+        3. steps/sec and the fraction of time spent waiting for input are measured per flush window
+        summaries use the global step, so epochs do not overwrite each other in TensorBoard
+    """
+
+    def __init__(self, names, summary_writer, flush_steps=100, percentiles=(50, 90, 99)):
+        """
+        :param names: names of the values passed to record(), in order
+        :param summary_writer: tf.compat.v2.summary file writer
+        :param flush_steps: steps aggregated per flush
+        :param percentiles: percentiles written next to the mean
+        """
+        self.names = list(names)
+        self.summary_writer = summary_writer
+        self.flush_steps = flush_steps
+        self.percentiles = percentiles
+        self.buffer = tf.Variable(tf.zeros((flush_steps, len(self.names))), trainable=False)
+        self.row = 0
+        self.window_start = time.time()
+        self.input_wait = 0.0
+        self.queue = queue.Queue(maxsize=8)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def reset_window(self):
+        """
+            start the steps/sec and input wait window now, so time spent outside the train loop
+            (validation, checkpoints, triplet mining) is not counted, call it after a flush
+        """
+        self.window_start = time.time()
+        self.input_wait = 0.0
+
+    def timed(self, dataset):
+        """
+            iterate dataset, the time spent in next() is counted as input wait,
+            the window is reset when the first item is requested
+        """
+        iterator = iter(dataset)
+        if self.row == 0:
+            self.reset_window()
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.input_wait += time.time() - start
+            yield item
+
+    def record(self, values, global_step):
+        """
+        :param values: scalar tensors (or numbers) in the order of names, stay on device
+        :param global_step: python int, step of the summaries when this row is flushed
+        """
+        self.buffer[self.row].assign(tf.stack([tf.cast(v, tf.float32) for v in values]))
+        self.row += 1
+        if self.row == self.flush_steps:
+            self.flush(global_step)
+
+    def flush(self, global_step):
+        if self.row == 0:
+            return
+        elapsed = time.time() - self.window_start
+        # snapshot, the buffer is reused right away
+        values = tf.identity(self.buffer[:self.row])
+        self.queue.put((values, global_step, self.row / elapsed, self.input_wait / elapsed))
+        self.row = 0
+        self.reset_window()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            values, global_step, steps_per_sec, input_wait = item
+            values = values.numpy()
+            means = np.mean(values, axis=0)
+            with self.summary_writer.as_default():
+                for i, name in enumerate(self.names):
+                    tf.compat.v2.summary.scalar(name, means[i], step=global_step)
+                    for q, p in zip(self.percentiles, np.percentile(values[:, i], self.percentiles)):
+                        tf.compat.v2.summary.scalar('{}/p{}'.format(name, q), p, step=global_step)
+                tf.compat.v2.summary.scalar('steps_per_sec', steps_per_sec, step=global_step)
+                tf.compat.v2.summary.scalar('input_wait', input_wait, step=global_step)
+            print('step: {}, {}, steps/sec: {:.2f}, input wait: {:.1%}'.format(
+                global_step, ', '.join('{}: {:.4f}'.format(n, m) for n, m in zip(self.names, means)),
+                steps_per_sec, input_wait))
+            self.queue.task_done()
+
+    def close(self, global_step):
+        self.flush(global_step)
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,55 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import datetime
+import platform
+import sys
+
+import tensorflow as tf
+import yaml
+
+from common.benchmark import report, run
+from recognition.train import Trainer
+
+tf.enable_eager_execution()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark recognition training throughput.')
+    parser.add_argument('--config_path', type=str, help='path to config path', default='configs/config.yaml')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed steps (tracing, autotune)')
+    parser.add_argument('--steps', type=int, default=50, help='timed steps')
+    parser.add_argument('--output', type=str, default=None, help='append the json result to this file')
+    parser.add_argument('--synthetic', action='store_true', help='random in-memory data (data_format: synthetic)')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    with open(args.config_path) as cfg:
+        config = yaml.load(cfg, Loader=yaml.FullLoader)
+    if args.synthetic:
+        config['data_format'] = 'synthetic'
+    # model, optimizer and data only, nothing is restored or written to the run's dirs
+    t = Trainer(config, benchmark=True)
+
+    # offline triplets are mined once, like at the start of an epoch
+    dataset, step_fn, _ = t.epoch_data()
+    if dataset is None:
+        raise ValueError('No triplets to benchmark')
+
+    result = run(dataset, step_fn, args.warmup, args.steps, t.accumulator.step)
+    result.update({'script': 'recognition', 'time': datetime.datetime.now().isoformat(),
+                   'host': platform.node(), 'tf_version': tf.__version__, 'config_path': args.config_path,
+                   'loss_type': t.loss_type, 'data_format': config.get('data_format', 'folder'),
+                   'accum_steps': t.accumulator.accum_steps, 'precision': t.precision,
+                   'warmup': args.warmup, 'steps': args.steps})
+    report(result, args.output)
+
+
+if __name__ == '__main__':
+    main()
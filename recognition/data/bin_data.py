@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import mmap
+import os
+import pickle
+
+import numpy as np
+import tensorflow as tf
+
+from recognition.data.pair_set import PairSet
+
+tf.enable_eager_execution()
+
+
+class BinData:
+    """
+        packed insightface verification set (lfw.bin, cfp_fp.bin, agedb_30.bin ...),
+        a pickled (list of encoded images, issame list), image 2i and 2i+1 is pair i.
+        images are decoded once into a uint8 memmap next to the bin (or in cache_dir),
+        later loads only map that file
+    """
+
+    def __init__(self, bin_path, image_size, cache_dir=None):
+        self.bin_path = os.path.expanduser(bin_path)
+        self.image_size = image_size
+        cache_dir = os.path.expanduser(cache_dir) if cache_dir else os.path.dirname(self.bin_path)
+        name = os.path.splitext(os.path.basename(self.bin_path))[0]
+        self.name = name
+        # a different bin with the same name, or a regenerated one, gets its own cache files
+        st = os.stat(self.bin_path)
+        key = hashlib.sha1('{}|{}|{}'.format(os.path.abspath(self.bin_path), st.st_size,
+                                             st.st_mtime_ns).encode('utf-8')).hexdigest()[:16]
+        self.image_path = os.path.join(cache_dir, '{}_{}_{}.u8'.format(name, key, image_size))
+        self.issame_path = os.path.join(cache_dir, '{}_{}_issame.npy'.format(name, key))
+        self.images = None
+        self.pairs = None
+
+    def _decode(self, image_raw):
+        image = tf.image.decode_image(image_raw, channels=3)
+        image.set_shape([None, None, 3])
+        image = tf.image.resize(tf.cast(image, tf.float32), (self.image_size, self.image_size))
+        return tf.cast(tf.round(tf.clip_by_value(image, 0, 255)), tf.uint8)
+
+    def _build(self, batch_size=256):
+        with open(self.bin_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                bins, issame = pickle.load(mm, encoding='bytes')
+        cache_dir = os.path.dirname(self.image_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        tmp_path = '{}.{}.tmp'.format(self.image_path, os.getpid())
+        images = np.memmap(tmp_path, dtype=np.uint8, mode='w+',
+                           shape=(len(bins), self.image_size, self.image_size, 3))
+        dataset = tf.data.Dataset.from_tensor_slices(bins)
+        dataset = dataset.map(self._decode, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.batch(batch_size)
+        begin = 0
+        for batch in dataset:
+            batch = batch.numpy()
+            images[begin:begin + batch.shape[0]] = batch
+            begin += batch.shape[0]
+        images.flush()
+        del images
+        np.save(self.issame_path, np.asarray(issame, dtype=np.bool_))
+        os.replace(tmp_path, self.image_path)
+
+    def load(self):
+        if not os.path.exists(self.image_path) or not os.path.exists(self.issame_path):
+            print('Decoding {} into {}'.format(self.bin_path, self.image_path))
+            self._build()
+        issame = np.load(self.issame_path)
+        self.images = np.memmap(self.image_path, dtype=np.uint8, mode='r',
+                                shape=(2 * len(issame), self.image_size, self.image_size, 3))
+        names = ['{}:{}'.format(self.name, i) for i in range(2 * len(issame))]
+        self.pairs = PairSet(names, np.arange(0, 2 * len(issame), 2), np.arange(1, 2 * len(issame), 2), issame)
+        return self
+
+    def get_data(self, batch_size):
+        """
+        :return: dataset of image batches in self.pairs.paths order, for Valid_Data
+        """
+        def gather_images(idx):
+            images = tf.numpy_function(lambda i: self.images[i], [idx], tf.uint8)
+            images.set_shape([None, self.image_size, self.image_size, 3])
+            return tf.cast(images, tf.float32) / 255
+
+        dataset = tf.data.Dataset.range(self.images.shape[0]).batch(batch_size)
+        dataset = dataset.map(gather_images, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        return dataset
@@ -5,22 +5,69 @@ import os
 import numpy as np
 import tensorflow as tf
 
+from recognition.data.image_cache import ImageCache
+from recognition.data.manifest import Manifest
+from recognition.data.pair_set import PairSet
+from recognition.data.record import SHARD_PATTERN, parse_record, read_meta
+from recognition.data.sampler import PKSampler
+from recognition.data.synthetic import SyntheticData
+from recognition.data.triplet_miner import TripletMiner
 from recognition.predict import get_embeddings
 
 tf.enable_eager_execution()
 
 
+def decode_image(image_raw, image_size):
+    # image = tf.image.decode_image(image_raw)
+    image = tf.image.decode_png(image_raw, channels=3)  # 部分图片是rgba，丢弃第四通道值
+    image = tf.cast(image, tf.float32)
+    image = image / 255
+    image = tf.image.resize(image, (image_size, image_size))
+    return image
+
+
 class GenerateData:
 
     def __init__(self, config=None):
         self.config = config
+        self.data_format = self.config.get('data_format', 'folder')  # folder, record or synthetic
         # paths: [[person0_img0.jpg, person0_img1.jpg], [person1_img0.jpg]]
         # labels:[[0, 0], [1]]
-        self.train_paths, self.train_labels = self._get_path_label(self.config['train_dir'])
-        self.valid_paths, _ = self._get_path_label(self.config['valid_dir'])
+        if self.data_format == 'folder':
+            self.train_paths, self.train_labels = self._get_path_label(self.config['train_dir'],
+                                                                       self.config.get('manifest_dir'),
+                                                                       self.config.get('manifest_workers', 16))
+        elif self.data_format == 'record':
+            # images are packed by recognition/data/record.py, no need to walk train_dir
+            if self.config.get('sampler', 'shuffle') != 'shuffle':
+                raise ValueError('data_format: record only supports sampler: shuffle')
+            if self.config.get('image_cache_dir'):
+                raise ValueError('image_cache_dir needs data_format: folder')
+            self.train_paths, self.train_labels = None, None
+            self.record_meta = read_meta(self.config['record_dir'])
+        elif self.data_format == 'synthetic':
+            # random images in memory, no dataset needed (benchmarks)
+            self.train_paths, self.train_labels = None, None
+            self.synthetic = SyntheticData(self.config.get('synthetic_ids', 1000), self.config['image_size'],
+                                           self.config.get('synthetic_images', 20),
+                                           max_images=self.config.get('synthetic_max_images', 200),
+                                           pool_size=self.config.get('synthetic_pool', 256))
+        else:
+            raise ValueError('Invalid data format')
+        if self.data_format == 'synthetic':
+            self.valid_paths = None
+        else:
+            self.valid_paths, _ = self._get_path_label(self.config['valid_dir'], self.config.get('manifest_dir'),
+                                                       self.config.get('manifest_workers', 16))
+        self.image_cache = None
+        self.triplet_miner = None
 
     @staticmethod   # 声明静态方法，不需要实例化即可调用(实例化后同样可调用)
-    def _get_path_label(image_dir):
+    def _get_path_label(image_dir, manifest_dir=None, workers=16):
+        if manifest_dir:
+            # persisted index, only changed id dirs are listed again
+            return Manifest(image_dir, manifest_dir, workers).get_path_label()
+
         image_dir = os.path.expanduser(image_dir)   # 把path中包含的"~"和"~user"转换成用户目录
         ids = list(os.listdir(image_dir))
         ids.sort()
@@ -38,11 +85,7 @@ class GenerateData:
 
     def _preprocess(self, image_path, training=True):
         image_raw = tf.io.read_file(image_path)
-        # image = tf.image.decode_image(image_raw)
-        image = tf.image.decode_png(image_raw, channels=3)  # 部分图片是rgba，丢弃第四通道值
-        image = tf.cast(image, tf.float32)
-        image = image / 255
-        image = tf.image.resize(image, (self.config['image_size'], self.config['image_size']))
+        image = decode_image(image_raw, self.config['image_size'])
 
         # image = tf.image.resize(image, (224, 224))
         # image = tf.image.random_crop(image, size=[112, 112, 3])
@@ -56,6 +99,12 @@ class GenerateData:
 
         return image, label
 
+    def _preprocess_train_record(self, serialized):
+        image_raw, label = parse_record(serialized)
+        image = decode_image(image_raw, self.config['image_size'])
+
+        return image, label
+
     def _preprocess_train_triplet(self, image_path1, image_path2, image_path3):
         image1 = self._preprocess(image_path1, training=True)
         image2 = self._preprocess(image_path2, training=True)
@@ -69,7 +118,76 @@ class GenerateData:
 
         return image1, image2, label
 
+    def _get_record_train_data(self):
+        record_dir = os.path.expanduser(self.config['record_dir'])
+        files = tf.data.Dataset.list_files(os.path.join(record_dir, SHARD_PATTERN), shuffle=True)
+        # read several shards at once, small-file io is replaced by a few sequential streams
+        train_dataset = files.interleave(tf.data.TFRecordDataset,
+                                         cycle_length=self.config.get('record_readers', 8),
+                                         block_length=1,
+                                         num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        train_dataset = train_dataset.shuffle(self.config.get('shuffle_buffer', 10000))
+        train_dataset = train_dataset.map(self._preprocess_train_record,
+                                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        train_dataset = train_dataset.batch(self.config['batch_size'])
+        train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+        return train_dataset, self.record_meta['cat_num']
+
+    def _get_image_cache(self, paths):
+        if self.image_cache is None:
+            self.image_cache = ImageCache(self.config['image_cache_dir'], paths, self.config['image_size'],
+                                          decode_image, self.config.get('manifest_workers', 16)).load()
+        return self.image_cache
+
+    def _get_cached_train_data(self, paths, labels):
+        cache = self._get_image_cache(paths)
+        total = len(paths)
+        # only int indices are shuffled, images are gathered from the memmap per batch
+        train_dataset = tf.data.Dataset.from_tensor_slices((tf.range(total), labels))
+        train_dataset = train_dataset.shuffle(total)
+        train_dataset = train_dataset.batch(self.config['batch_size'])
+        train_dataset = train_dataset.map(lambda idx, label: (cache.gather_images(idx), label),
+                                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+        return train_dataset
+
+    def _get_pk_train_data(self, paths):
+        sampler = PKSampler([len(cls) for cls in self.train_paths], self.config['pk_ids'], self.config['pk_images'])
+        train_dataset = tf.data.Dataset.from_generator(sampler, (tf.int64, tf.int32),
+                                                       (tf.TensorShape([None]), tf.TensorShape([None])))
+        if self.config.get('image_cache_dir'):
+            cache = self._get_image_cache(paths)
+            train_dataset = train_dataset.map(lambda idx, label: (cache.gather_images(idx), label),
+                                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        else:
+            flat_paths = np.array(paths, dtype=object)
+
+            def lookup_paths(idx, label):
+                batch_paths = tf.numpy_function(lambda i: flat_paths[i], [idx], tf.string)
+                batch_paths.set_shape([None])
+                return batch_paths, label
+
+            train_dataset = train_dataset.map(lookup_paths)
+            train_dataset = train_dataset.apply(tf.data.experimental.unbatch())
+            train_dataset = train_dataset.map(self._preprocess_train,
+                                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            train_dataset = train_dataset.batch(sampler.batch_size)
+        train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+        return train_dataset
+
     def get_train_data(self):
+        if self.data_format == 'record':
+            return self._get_record_train_data()
+        if self.data_format == 'synthetic':
+            if self.config.get('sampler', 'shuffle') == 'pk':
+                train_dataset = self.synthetic.get_pk_train_data(self.config['pk_ids'], self.config['pk_images'])
+            else:
+                train_dataset = self.synthetic.get_train_data(self.config['batch_size'])
+            return train_dataset, self.synthetic.cat_num
+
         paths, labels = self.train_paths, self.train_labels
         cat_num = len(paths)
         paths = [path for cls in paths for path in cls] # 2 dim -> 1 dim
@@ -77,6 +195,11 @@ class GenerateData:
         assert (len(paths) == len(labels))
         total = len(paths)
         # logger.info("the total pic number is {}".format(total))
+        if self.config.get('sampler', 'shuffle') == 'pk':
+            return self._get_pk_train_data(paths), cat_num
+        if self.config.get('image_cache_dir'):
+            return self._get_cached_train_data(paths, labels), cat_num
+
         train_dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
         train_dataset = train_dataset.cache()
         train_dataset = train_dataset.shuffle(total)
@@ -89,61 +212,44 @@ class GenerateData:
 
         return train_dataset, cat_num
 
-    def get_train_triplets_data(self, model):
-        paths, labels = self.train_paths, self.train_labels
-        begins = []  # include
-        ends = []  # not include
-        length = 0
-        for l in labels:
-            for _ in l:
-                begins.append(length)
-                ends.append(length + len(l))
-            length += len(l)
-
-        paths = [path for cls in paths for path in cls]
-        labels = [label for cls in labels for label in cls]
-        assert (len(paths) == len(labels))
-
-        train_dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
-        train_dataset = train_dataset.cache()
-        train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-        train_dataset = train_dataset.map(self._preprocess_train, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        train_dataset = train_dataset.batch(self.config['batch_size'])
+    def _embed_train_images(self, model, paths, idx):
+        """
+        :return: yield (idx_batch, emb_batch) of the train images in idx
+        """
+        batch_size = self.config['batch_size']
+        if self.config.get('image_cache_dir'):
+            cache = self._get_image_cache(paths)
+            dataset = tf.data.Dataset.from_tensor_slices(idx).batch(batch_size)
+            dataset = dataset.map(lambda i: (i, cache.gather_images(i)),
+                                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        else:
+            sub_paths = [paths[i] for i in idx]
+            dataset = tf.data.Dataset.from_tensor_slices((idx, sub_paths))
+            dataset = dataset.map(lambda i, path: (i, self._preprocess(path, training=False)),
+                                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            dataset = dataset.batch(batch_size)
+        dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        for idx_batch, img in dataset:
+            yield idx_batch.numpy(), get_embeddings(model, img).numpy()
 
-        embs = None
-        labels = None
-        for img, label in train_dataset:
-            emb = get_embeddings(model, img)
-            if embs is None:
-                embs = emb
-                labels = label
-            else:
-                embs = tf.concat([embs, emb], axis=0)
-                labels = tf.concat([labels, label], axis=0)
-
-        num_triplets = 0
-        anchor = []
-        pos = []
-        neg = []
-        for a_idx in range(labels.shape[0]):
-            begin = begins[a_idx]  # include
-            end = ends[a_idx]  # not include
-            neg_dists = np.sum(np.square(embs - embs[a_idx]), axis=1)
-            # neg_dists[begin:end] = np.NaN
-            neg_dists[begin:end] = np.Inf
-            for p_idx in range(a_idx + 1, end):
-                pos_dist = np.sum(np.square(embs[p_idx] - embs[a_idx]))
-                all_neg = np.where(neg_dists - pos_dist < self.config['alpha'])[0]
-                num_neg = all_neg.shape[0]
-                if num_neg > 0:
-                    rnd_idx = np.random.randint(num_neg)
-                    n_idx = all_neg[rnd_idx]
-
-                    anchor.append(paths[a_idx])
-                    pos.append(paths[p_idx])
-                    neg.append(paths[n_idx])
-
-                    num_triplets += 1
+    def get_train_triplets_data(self, model):
+        if self.train_paths is None:
+            raise ValueError('Offline triplet mining needs data_format: folder')
+        paths = [path for cls in self.train_paths for path in cls]
+        if self.triplet_miner is None:
+            self.triplet_miner = TripletMiner([len(cls) for cls in self.train_paths], self.config['embedding_size'],
+                                              self.config['alpha'],
+                                              memory_mb=self.config.get('miner_memory_mb', 256),
+                                              top_k=self.config.get('miner_top_k', 64),
+                                              stale_fraction=self.config.get('miner_stale_fraction', 1.0),
+                                              emb_path=self.config.get('miner_emb_path'))
+        self.triplet_miner.refresh(lambda idx: self._embed_train_images(model, paths, idx))
+        anchor, pos, neg = self.triplet_miner.mine()
+
+        num_triplets = len(anchor)
+        paths = np.array(paths, dtype=object)
+        anchor, pos, neg = list(paths[anchor]), list(paths[pos]), list(paths[neg])
+        train_dataset = None
         if num_triplets > 0:
             train_dataset = tf.data.Dataset.from_tensor_slices((anchor, pos, neg))
             train_dataset = train_dataset.cache()
@@ -155,7 +261,7 @@ class GenerateData:
 
         return train_dataset, num_triplets
 
-    def get_val_data(self, num):
+    def _sample_val_pairs(self, num):
         paths = self.valid_paths
         paths1 = []
         paths2 = []
@@ -188,6 +294,10 @@ class GenerateData:
                     labels.append(False)
                     nn = nn + 1
 
+        return paths1, paths2, labels
+
+    def get_val_data(self, num):
+        paths1, paths2, labels = self._sample_val_pairs(num)
         val_dataset = tf.data.Dataset.from_tensor_slices((paths1, paths2, labels))
         val_dataset = val_dataset.cache()
         val_dataset = val_dataset.shuffle(num)
@@ -196,6 +306,28 @@ class GenerateData:
         val_dataset = val_dataset.batch(self.config['valid_batch_size'])
         return val_dataset
 
+    def get_val_pair_data(self, num, pairs_path=None):
+        """
+            validation pairs frozen to pairs_path (sampled and saved if it does not exist),
+            every unique image is decoded and embedded once
+        :return: dataset of the unique images, PairSet
+        """
+        if self.data_format == 'synthetic':
+            return self.synthetic.get_val_pair_data(num, self.config['valid_batch_size'])
+        if pairs_path and os.path.exists(os.path.expanduser(pairs_path)):
+            pairs = PairSet.load(pairs_path)
+        else:
+            pairs = PairSet.from_pairs(*self._sample_val_pairs(num))
+            if pairs_path:
+                pairs.save(pairs_path)
+
+        val_dataset = tf.data.Dataset.from_tensor_slices(pairs.paths)
+        val_dataset = val_dataset.map(lambda path: self._preprocess(path, training=False),
+                                      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        val_dataset = val_dataset.batch(self.config['valid_batch_size'])
+        val_dataset = val_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        return val_dataset, pairs
+
 
 def parse_args(argv):
     import argparse
@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+tf.enable_eager_execution()
+
+
+class ImageCache:
+    """
+        decoded uint8 images of a dataset in one memory-mapped file,
+        images are decoded once, later epochs only copy from the page cache
+    """
+
+    def __init__(self, cache_dir, paths, image_size, decode_fn, workers=16):
+        """
+        :param cache_dir: dir to put the cache file
+        :param paths: flattened image paths, the cache row i is paths[i]
+        :param image_size: images are resized to (image_size, image_size)
+        :param decode_fn: decode_fn(image_raw, image_size) -> float image in [0, 1]
+        :param workers: threads to stat the images when computing the cache key
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.paths = paths
+        self.image_size = image_size
+        self.decode_fn = decode_fn
+        self.workers = workers
+        self.shape = (len(paths), image_size, image_size, 3)
+        self.cache_path = os.path.join(self.cache_dir, self._key() + '.u8')
+        self.images = None
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def _key(self):
+        """
+            sha1 of image_size and every (path, size, mtime), an image replaced in place gets a new cache
+        """
+        h = hashlib.sha1()
+        h.update('{}|{}|'.format(self.image_size, len(self.paths)).encode('utf-8'))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for path, (size, mtime) in zip(self.paths, executor.map(self._stat, self.paths)):
+                h.update('{}|{}|{}\n'.format(path, size, mtime).encode('utf-8'))
+        return h.hexdigest()
+
+    def _decode_uint8(self, image_path):
+        image = self.decode_fn(tf.io.read_file(image_path), self.image_size)
+        return tf.cast(tf.round(image * 255), tf.uint8)
+
+    def _build(self, batch_size=256):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # write to a tmp file first, a finished cache file is never partial
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        images = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=self.shape)
+        dataset = tf.data.Dataset.from_tensor_slices(self.paths)
+        dataset = dataset.map(self._decode_uint8, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        begin = 0
+        for batch in dataset:
+            batch = batch.numpy()
+            images[begin:begin + batch.shape[0]] = batch
+            begin += batch.shape[0]
+        images.flush()
+        del images
+        os.replace(tmp_path, self.cache_path)
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            print('Building image cache {}'.format(self.cache_path))
+            self._build()
+        self.images = np.memmap(self.cache_path, dtype=np.uint8, mode='r', shape=self.shape)
+        return self
+
+    def gather(self, idx):
+        return self.images[idx]
+
+    def gather_images(self, idx):
+        """
+            tf op to gather a batch of cached images
+        :param idx: int tensor, shape=[N]
+        :return: float images in [0, 1], shape=[N, image_size, image_size, 3]
+        """
+        images = tf.numpy_function(self.gather, [idx], tf.uint8)
+        images.set_shape([None, self.image_size, self.image_size, 3])
+        images = tf.cast(images, tf.float32) / 255
+        return images
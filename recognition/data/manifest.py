@@ -0,0 +1,93 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_VERSION = 1
+
+
+def _scan_ids(image_dir, ids, old_dirs):
+    """
+        stat each identity dir, list it again only if its mtime changed
+    :return: list of (id, (mtime_ns, file names)), number of rescanned dirs
+    """
+    ret = []
+    rescanned = 0
+    for i in ids:
+        cur_dir = os.path.join(image_dir, i)
+        mtime = os.stat(cur_dir).st_mtime_ns
+        old = old_dirs.get(i)
+        if old is not None and old[0] == mtime:
+            ret.append((i, old))
+            continue
+        with os.scandir(cur_dir) as it:
+            fns = sorted(entry.name for entry in it)
+        ret.append((i, (mtime, fns)))
+        rescanned += 1
+    return ret, rescanned
+
+
+class Manifest:
+    """
+        persisted index of a facebank dir: {id: (dir mtime, file names)},
+        only identity dirs whose mtime changed are listed again
+    """
+
+    def __init__(self, image_dir, manifest_dir, workers=16, chunk_size=1000):
+        self.image_dir = os.path.expanduser(image_dir)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        manifest_dir = os.path.expanduser(manifest_dir)
+        name = hashlib.sha1(os.path.abspath(self.image_dir).encode('utf-8')).hexdigest()[:16]
+        self.manifest_path = os.path.join(manifest_dir, 'manifest_{}.pkl'.format(name))
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'rb') as f:
+            manifest = pickle.load(f)
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('image_dir') != self.image_dir:
+            return {}
+        return manifest['dirs']
+
+    def _save(self, dirs):
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        tmp_path = '{}.{}.tmp'.format(self.manifest_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': MANIFEST_VERSION, 'image_dir': self.image_dir, 'dirs': dirs}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.manifest_path)
+
+    def update(self):
+        old_dirs = self._load()
+        with os.scandir(self.image_dir) as it:
+            ids = [entry.name for entry in it if entry.is_dir()]
+        chunks = [ids[i:i + self.chunk_size] for i in range(0, len(ids), self.chunk_size)]
+
+        dirs = {}
+        rescanned = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for ret, num in executor.map(lambda chunk: _scan_ids(self.image_dir, chunk, old_dirs), chunks):
+                dirs.update(ret)
+                rescanned += num
+
+        if rescanned > 0 or len(dirs) != len(old_dirs):
+            self._save(dirs)
+        # logger.info("{} of {} ids rescanned".format(rescanned, len(dirs)))
+        return dirs
+
+    def get_path_label(self):
+        dirs = self.update()
+        ids = sorted(dirs.keys())
+        paths = []
+        labels = []
+        for label, i in enumerate(ids):
+            cur_dir = os.path.join(self.image_dir, i)
+            fns = dirs[i][1]
+            paths.append([os.path.join(cur_dir, fn) for fn in fns])
+            labels.append([label] * len(fns))
+        return paths, labels
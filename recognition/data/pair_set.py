@@ -0,0 +1,51 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+
+import numpy as np
+
+
+class PairSet:
+    """
+        verification pairs over a list of unique images,
+        pair i is (paths[idx1[i]], paths[idx2[i]]) with label labels[i]
+    """
+
+    def __init__(self, paths, idx1, idx2, labels):
+        self.paths = list(paths)
+        self.idx1 = np.asarray(idx1, dtype=np.int64)
+        self.idx2 = np.asarray(idx2, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.bool_)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def from_pairs(cls, paths1, paths2, labels):
+        path_idx = {}
+        for path in list(paths1) + list(paths2):
+            if path not in path_idx:
+                path_idx[path] = len(path_idx)
+        idx1 = [path_idx[path] for path in paths1]
+        idx2 = [path_idx[path] for path in paths2]
+        return cls(list(path_idx.keys()), idx1, idx2, labels)
+
+    def save(self, path):
+        path = os.path.expanduser(path)
+        pair_dir = os.path.dirname(path)
+        if pair_dir and not os.path.exists(pair_dir):
+            os.makedirs(pair_dir)
+        with open(path, 'wb') as f:
+            np.savez(f, paths=np.array(self.paths), idx1=self.idx1, idx2=self.idx2, labels=self.labels)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(os.path.expanduser(path)) as data:
+            return cls([str(p) for p in data['paths']], data['idx1'], data['idx2'], data['labels'])
+
+    def cal_sims(self, embs):
+        """
+            cos similarity of every pair by index lookup
+        :param embs: l2 normalized embeddings of self.paths, shape=[len(paths), D]
+        """
+        return np.sum(embs[self.idx1] * embs[self.idx2], axis=-1)
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+
+import tensorflow as tf
+
+tf.enable_eager_execution()
+
+META_NAME = 'meta.json'
+SHARD_PATTERN = 'train-*-of-*.tfrecord'
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def write_records(paths, labels, record_dir, num_shards=64):
+    """
+        pack a facebank into sharded TFRecord files, each record holds
+        image: the encoded image bytes (not decoded)
+        label: the identity index
+    :param paths: [[person0_img0.jpg, person0_img1.jpg], [person1_img0.jpg]]
+    :param labels: [[0, 0], [1]]
+    :param record_dir: output dir
+    :param num_shards: number of shard files
+    :return: meta dict, also saved as record_dir/meta.json
+    """
+    record_dir = os.path.expanduser(record_dir)
+    if not os.path.exists(record_dir):
+        os.makedirs(record_dir)
+
+    names = [os.path.join(record_dir, 'train-{:05d}-of-{:05d}.tfrecord'.format(i, num_shards))
+             for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(name) for name in names]
+    index = 0
+    try:
+        for cls_paths, cls_labels in zip(paths, labels):
+            for path, label in zip(cls_paths, cls_labels):
+                with open(path, 'rb') as f:
+                    image_raw = f.read()
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image': _bytes_feature(image_raw),
+                    'label': _int64_feature(label),
+                }))
+                # round robin, so every shard mixes all identities
+                writers[index % num_shards].write(example.SerializeToString())
+                index += 1
+    finally:
+        for writer in writers:
+            writer.close()
+
+    meta = {'cat_num': len(paths), 'total': index, 'num_shards': num_shards}
+    with open(os.path.join(record_dir, META_NAME), 'w') as f:
+        json.dump(meta, f)
+
+    return meta
+
+
+def read_meta(record_dir):
+    with open(os.path.join(os.path.expanduser(record_dir), META_NAME)) as f:
+        return json.load(f)
+
+
+def parse_record(serialized):
+    features = tf.io.parse_single_example(serialized, features={
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+    })
+    return features['image'], tf.cast(features['label'], tf.int32)
+
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack facebank into TFRecord shards.')
+    parser.add_argument('--config_path', type=str, help='path to config path', default='../configs/config.yaml')
+    parser.add_argument('--num_shards', type=int, help='number of shards', default=None)
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main():
+    import sys
+    import yaml
+    from recognition.data.generate_data import GenerateData
+    args = parse_args(sys.argv[1:])
+    with open(args.config_path) as cfg:
+        config = yaml.load(cfg, Loader=yaml.FullLoader)
+    num_shards = args.num_shards if args.num_shards is not None else config.get('record_shards', 64)
+
+    paths, labels = GenerateData._get_path_label(config['train_dir'], config.get('manifest_dir'),
+                                                 config.get('manifest_workers', 16))
+    meta = write_records(paths, labels, config['record_dir'], num_shards)
+    print('packed {} images of {} ids into {} shards at {}'.format(meta['total'], meta['cat_num'], num_shards,
+                                                                   config['record_dir']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+
+
+class PKSampler:
+    """
+        draw P identities x K images per batch from a permutation of the identities,
+        memory is O(identities) instead of a shuffle buffer of every image
+    """
+
+    def __init__(self, counts, p, k, seed=None):
+        """
+        :param counts: image number of each identity, images of identity i are
+                       [begins[i], begins[i] + counts[i]) in the flattened facebank
+        :param p: identities per batch
+        :param k: images per identity
+        :param seed: random seed, None for a different order every run
+        """
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.begins = np.concatenate(([0], np.cumsum(self.counts)[:-1])).astype(np.int64)
+        self.ids = np.where(self.counts > 0)[0]
+        if len(self.ids) < p:
+            raise ValueError('P should not be larger than the identity number')
+        self.p = p
+        self.k = k
+        self.seed = seed
+        self.batch_size = p * k
+        self.num_batches = max(int(np.sum(self.counts)) // self.batch_size, 1)  # batches of one epoch
+
+    def _sample_id(self, rng, i):
+        count = self.counts[i]
+        # sample with replacement only if the identity has less than k images
+        offsets = rng.choice(count, self.k, replace=count < self.k)
+        return self.begins[i] + offsets
+
+    def __call__(self):
+        """
+            generator of one epoch
+        :return: yield (idx, label), idx is the image index in the flattened facebank, shape=[P*K]
+        """
+        rng = np.random.RandomState(self.seed)
+        num = 0
+        while num < self.num_batches:
+            perm = rng.permutation(self.ids)
+            for begin in range(0, len(perm) - self.p + 1, self.p):
+                if num >= self.num_batches:
+                    break
+                chosen = perm[begin:begin + self.p]
+                idx = np.concatenate([self._sample_id(rng, i) for i in chosen])
+                label = np.repeat(chosen, self.k).astype(np.int32)
+                yield idx, label
+                num += 1
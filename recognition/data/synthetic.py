@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+from recognition.data.pair_set import PairSet
+from recognition.data.sampler import PKSampler
+
+tf.enable_eager_execution()
+
+
+class SyntheticData:
+    """
+        random train data without any file io, to benchmark the model and the input pipeline
+        1. images per identity follow a long tail (lognormal, like ms1m / glint), clipped to [min_images, max_images]
+        2. images are gathered from a fixed pool of random uint8 images kept in memory,
+           sample i uses pool[i % pool_size]
+    """
+
+    def __init__(self, num_ids, image_size, mean_images=20, min_images=2, max_images=200, pool_size=256, sigma=1.0,
+                 seed=0):
+        """
+        :param num_ids: identity number
+        :param image_size:
+        :param mean_images: mean image number per identity before clipping
+        :param min_images:
+        :param max_images:
+        :param pool_size: random images kept in memory
+        :param sigma: lognormal sigma, larger for a longer tail
+        :param seed:
+        """
+        rng = np.random.RandomState(seed)
+        counts = rng.lognormal(np.log(mean_images) - sigma ** 2 / 2, sigma, size=num_ids)
+        self.counts = np.clip(np.round(counts), min_images, max_images).astype(np.int64)
+        self.labels = np.repeat(np.arange(num_ids, dtype=np.int32), self.counts)
+        self.image_size = image_size
+        self.pool_size = pool_size
+        self.pool = rng.randint(0, 256, size=(pool_size, image_size, image_size, 3)).astype(np.uint8)
+        self._pool_tensor = None
+
+    @property
+    def cat_num(self):
+        return len(self.counts)
+
+    @property
+    def total(self):
+        return len(self.labels)
+
+    def gather_images(self, idx):
+        """
+        :param idx: image indices, int tensor, shape=[B]
+        :return: float images in [0, 1], shape=[B, S, S, 3]
+        """
+        if self._pool_tensor is None:
+            self._pool_tensor = tf.constant(self.pool)
+        images = tf.gather(self._pool_tensor, tf.math.floormod(tf.cast(idx, tf.int64), self.pool_size))
+        return tf.cast(images, tf.float32) / 255
+
+    def get_train_data(self, batch_size, sampler=None):
+        """
+        :param sampler: None to shuffle all images, or a PKSampler over self.counts
+        :return: dataset of (image, label) batches, same as GenerateData.get_train_data
+        """
+        if sampler is not None:
+            train_dataset = tf.data.Dataset.from_generator(sampler, (tf.int64, tf.int32),
+                                                           (tf.TensorShape([None]), tf.TensorShape([None])))
+        else:
+            train_dataset = tf.data.Dataset.from_tensor_slices((tf.range(self.total), self.labels))
+            train_dataset = train_dataset.shuffle(self.total)
+            train_dataset = train_dataset.batch(batch_size)
+        train_dataset = train_dataset.map(lambda idx, label: (self.gather_images(idx), label),
+                                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+        return train_dataset
+
+    def get_pk_train_data(self, p, k, seed=None):
+        return self.get_train_data(p * k, PKSampler(self.counts, p, k, seed))
+
+    def get_val_pair_data(self, num, batch_size):
+        """
+            num pairs over 2 * num unique images, half of them labeled as the same identity
+        :return: dataset of the unique images, PairSet
+        """
+        names = ['synthetic:{}'.format(i) for i in range(2 * num)]
+        labels = np.arange(num) % 2 == 0
+        pairs = PairSet(names, np.arange(0, 2 * num, 2), np.arange(1, 2 * num, 2), labels)
+
+        val_dataset = tf.data.Dataset.range(2 * num).batch(batch_size)
+        val_dataset = val_dataset.map(self.gather_images, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        val_dataset = val_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        return val_dataset, pairs
@@ -0,0 +1,137 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import math
+import os
+
+import numpy as np
+
+
+class TripletMiner:
+    """
+        offline triplet miner with bounded memory
+        1. embeddings live in a preallocated (optionally memory-mapped) buffer
+        2. each refresh only re-embeds a stale fraction of the images, oldest first
+        3. negative candidates are the top_k closest other-identity images of each anchor,
+           found with tiled matmuls whose distance tile stays under memory_mb
+    """
+
+    def __init__(self, counts, embedding_size, alpha, memory_mb=256, top_k=64, stale_fraction=1.0, emb_path=None,
+                 seed=None):
+        """
+        :param counts: image number of each identity, identity i owns [begins[i], begins[i] + counts[i])
+        :param embedding_size:
+        :param alpha: triplet margin
+        :param memory_mb: memory cap of a distance tile
+        :param top_k: negative candidates kept per anchor
+        :param stale_fraction: fraction of the images re-embedded per refresh
+        :param emb_path: memmap the embedding buffer to this file, None to keep it in RAM
+        :param seed:
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        self.total = int(np.sum(counts))
+        self.begins = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+        self.counts = counts
+        self.labels = np.repeat(np.arange(len(counts)), counts)
+        self.alpha = alpha
+        self.top_k = top_k
+        self.stale_fraction = stale_fraction
+        self.rng = np.random.RandomState(seed)
+        # bytes per tile element: the float32 distances (built in place, no temporaries), the bool same-identity
+        # mask, freed before the top k, and the int64 indices of argpartition
+        self.tile = max(int(math.sqrt(memory_mb * 1024 * 1024 / (4 + 1 + 8))), 1)
+
+        shape = (self.total, embedding_size)
+        if emb_path:
+            emb_path = os.path.expanduser(emb_path)
+            emb_dir = os.path.dirname(emb_path)
+            if emb_dir and not os.path.exists(emb_dir):
+                os.makedirs(emb_dir)
+            self.embs = np.memmap(emb_path, dtype=np.float32, mode='w+', shape=shape)
+        else:
+            self.embs = np.zeros(shape, dtype=np.float32)
+        self.initialized = False
+        self.cursor = 0
+
+    def refresh(self, embed_fn):
+        """
+            re-embed the stale part of the buffer
+        :param embed_fn: embed_fn(idx) yields (idx_batch, emb_batch) of the given image indices
+        :return: number of re-embedded images
+        """
+        if not self.initialized:
+            idx = np.arange(self.total)
+        else:
+            num = min(int(math.ceil(self.stale_fraction * self.total)), self.total)
+            idx = (self.cursor + np.arange(num)) % self.total
+            self.cursor = (self.cursor + num) % self.total
+        for idx_batch, emb_batch in embed_fn(idx):
+            self.embs[idx_batch] = emb_batch
+        self.initialized = True
+        return len(idx)
+
+    def _negative_candidates(self):
+        k = min(self.top_k, self.total)
+        cand_idx = np.zeros((self.total, k), dtype=np.int64)
+        cand_dist = np.zeros((self.total, k), dtype=np.float32)
+        # no N x D temporary, the buffer may be a memmap larger than memory_mb
+        square = np.einsum('ij,ij->i', self.embs, self.embs)
+        for row in range(0, self.total, self.tile):
+            rows = slice(row, min(row + self.tile, self.total))
+            row_embs = np.asarray(self.embs[rows])
+            best_idx = np.full((row_embs.shape[0], k), -1, dtype=np.int64)
+            best_dist = np.full((row_embs.shape[0], k), np.inf, dtype=np.float32)
+            for col in range(0, self.total, self.tile):
+                cols = slice(col, min(col + self.tile, self.total))
+                dist = np.dot(row_embs, np.asarray(self.embs[cols]).T)
+                dist *= -2
+                dist += square[rows, None]
+                dist += square[None, cols]
+                dist[self.labels[rows, None] == self.labels[None, cols]] = np.inf
+                # top k of this tile, merged with the running top k
+                kk = min(k, dist.shape[1])
+                # copy the slice, a view would keep the whole int64 tile alive
+                part = np.array(np.argpartition(dist, kk - 1, axis=1)[:, :kk])
+                merged_dist = np.concatenate((best_dist, np.take_along_axis(dist, part, axis=1)), axis=1)
+                # free the tile before the next one is computed
+                del dist
+                merged_idx = np.concatenate((best_idx, part + col), axis=1)
+                keep = np.argpartition(merged_dist, k - 1, axis=1)[:, :k]
+                best_dist = np.take_along_axis(merged_dist, keep, axis=1)
+                best_idx = np.take_along_axis(merged_idx, keep, axis=1)
+            cand_idx[rows] = best_idx
+            cand_dist[rows] = best_dist
+        return cand_idx, cand_dist
+
+    def mine(self):
+        """
+            for every (anchor, pos) pair of an identity, pick a random candidate neg
+            with neg_dist - pos_dist < alpha
+        :return: anchor, pos, neg image indices
+        """
+        cand_idx, cand_dist = self._negative_candidates()
+        anchors = []
+        poses = []
+        negs = []
+        for begin, count in zip(self.begins, self.counts):
+            if count < 2:
+                continue
+            embs = np.asarray(self.embs[begin:begin + count])
+            square = np.sum(np.square(embs), axis=1)
+            pos_dist = square[:, None] - 2 * np.dot(embs, embs.T) + square[None, :]
+            a, p = np.triu_indices(count, 1)
+            valid = cand_dist[begin + a] - pos_dist[a, p][:, None] < self.alpha
+            valid &= np.isfinite(cand_dist[begin + a])
+            has_neg = np.any(valid, axis=1)
+            if not np.any(has_neg):
+                continue
+            # random choice among the valid candidates of each pair
+            scores = np.where(valid, self.rng.random_sample(valid.shape), -1)
+            choice = np.argmax(scores, axis=1)
+            anchors.append(begin + a[has_neg])
+            poses.append(begin + p[has_neg])
+            negs.append(cand_idx[begin + a[has_neg], choice[has_neg]])
+
+        if len(anchors) == 0:
+            empty = np.zeros((0,), dtype=np.int64)
+            return empty, empty, empty
+        return np.concatenate(anchors), np.concatenate(poses), np.concatenate(negs)
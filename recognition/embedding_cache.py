@@ -0,0 +1,156 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from recognition.data.generate_data import decode_image
+from recognition.predict import get_embeddings
+
+tf.enable_eager_execution()
+
+
+def model_fingerprint(model):
+    """
+        sha1 of the backbone variable names and values, changes whenever the weights change
+    """
+    sha = hashlib.sha1()
+    for var in sorted(model.backbone.variables, key=lambda v: v.name):
+        sha.update(var.name.encode('utf-8'))
+        sha.update(var.numpy().tobytes())
+    return sha.hexdigest()
+
+
+class EmbeddingCache:
+    """
+        content addressed cache in front of get_embeddings,
+        key is sha1(sha1 of the model weights + encoded image bytes), so re-uploads of the same file never
+        reach the model and new weights never see stale embeddings, the model must already be built
+        1. in-memory LRU evicting the least recently used entries above max_mb
+        2. optional on-disk tier, one .npy per key, survives restarts and is shared between processes
+    """
+
+    def __init__(self, model, image_size, max_mb=256, disk_dir=None, batch_size=64):
+        """
+        :param model: MyModel
+        :param image_size:
+        :param max_mb: memory cap of the in-memory tier
+        :param disk_dir: directory of the on-disk tier, None to disable it
+        :param batch_size: misses are embedded in batches of this size
+        """
+        self.model = model
+        self.image_size = image_size
+        self.max_bytes = max_mb * 1024 * 1024
+        self.batch_size = batch_size
+        # sha1 hex digest of the weights, so it is always a safe path component
+        self.fingerprint = model_fingerprint(model)
+        self.disk_dir = None
+        if disk_dir:
+            self.disk_dir = os.path.join(os.path.expanduser(disk_dir), self.fingerprint[:16])
+            if not os.path.exists(self.disk_dir):
+                os.makedirs(self.disk_dir)
+        self.lru = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, image_raw):
+        sha = hashlib.sha1(self.fingerprint.encode('utf-8'))
+        sha.update(image_raw)
+        return sha.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.npy')
+
+    def _put(self, key, emb):
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                return
+            self.lru[key] = emb
+            self.bytes += emb.nbytes
+            while self.bytes > self.max_bytes and len(self.lru) > 1:
+                _, old = self.lru.popitem(last=False)
+                self.bytes -= old.nbytes
+
+    def _get(self, key):
+        with self.lock:
+            emb = self.lru.get(key)
+            if emb is not None:
+                self.lru.move_to_end(key)
+                self.hits += 1
+                return emb
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                emb = np.load(path)
+                self._put(key, emb)
+                with self.lock:
+                    self.disk_hits += 1
+                return emb
+        return None
+
+    def _save(self, key, emb):
+        path = self._disk_path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, emb)
+        os.replace(tmp_path, path)
+
+    def _embed(self, images_raw):
+        images = tf.stack([decode_image(image_raw, self.image_size) for image_raw in images_raw])
+        return get_embeddings(self.model, images).numpy()
+
+    def get_embeddings(self, images_raw):
+        """
+        :param images_raw: list of encoded image bytes
+        :return: l2 normalized embeddings, numpy, shape=[N, D]
+        """
+        keys = [self.key(image_raw) for image_raw in images_raw]
+        embs = [self._get(key) for key in keys]
+
+        # identical images in one call are embedded once
+        miss_keys = OrderedDict()
+        for i, (key, emb) in enumerate(zip(keys, embs)):
+            if emb is None:
+                miss_keys.setdefault(key, i)
+        with self.lock:
+            self.misses += len(miss_keys)
+            self.hits += sum(emb is None for emb in embs) - len(miss_keys)
+        miss_keys = list(miss_keys.items())
+        new_embs = {}
+        for begin in range(0, len(miss_keys), self.batch_size):
+            batch = miss_keys[begin:begin + self.batch_size]
+            batch_embs = self._embed([images_raw[i] for _, i in batch])
+            for (key, _), emb in zip(batch, batch_embs):
+                # copy the row, a view would keep the whole batch alive in the LRU
+                emb = np.array(emb)
+                new_embs[key] = emb
+                self._put(key, emb)
+                if self.disk_dir is not None:
+                    self._save(key, emb)
+
+        embs = [new_embs[key] if emb is None else emb for key, emb in zip(keys, embs)]
+        return np.stack(embs)
+
+    def embed_paths(self, paths):
+        images_raw = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images_raw.append(f.read())
+        return self.get_embeddings(images_raw)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': (self.hits + self.disk_hits) / total if total > 0 else 0.0,
+                    'entries': len(self.lru), 'mb': self.bytes / 1024 / 1024}
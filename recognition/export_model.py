@@ -3,45 +3,254 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import argparse
 import os
 import sys
+import time
 
+import numpy as np
 import tensorflow as tf
 import yaml
 
 from recognition.backbones.resnet_v1 import ResNet_v1_50
-from recognition.data.generate_data import GenerateData
+from recognition.data.generate_data import GenerateData, decode_image
 from recognition.models.models import MyModel
+from recognition.predict import get_embeddings
 
 tf.enable_eager_execution()
 
 
+class EmbeddingModule(tf.Module):
+    """
+        inference only export of the embedding branch, the classes-sized dense heads are left out
+        serve(images) takes float images in [0, 1], shape=[None, image_size, image_size, 3],
+        and returns {'embeddings': l2 normalized embeddings}
+    """
+
+    def __init__(self, backbone, image_size):
+        super(EmbeddingModule, self).__init__()
+        self.backbone = backbone
+        self.serve = tf.function(self._serve, input_signature=[
+            tf.TensorSpec([None, image_size, image_size, 3], tf.float32, name='images')])
+
+    def _serve(self, images):
+        prelogits = self.backbone(images, training=False)
+        return {'embeddings': tf.nn.l2_normalize(prelogits, axis=-1, name='embeddings')}
+
+
+def sample_images(config, num, seed=0):
+    """
+        decoded images for calibration and parity checks, sampled from the facebank (train_dir) in folder mode,
+        else the first images of the GenerateData train pipeline (record shards or synthetic)
+    """
+    if config.get('data_format', 'folder') != 'folder':
+        train_data, _ = GenerateData(config).get_train_data()
+        images = []
+        total = 0
+        for batch, _ in train_data:
+            images.append(batch.numpy())
+            total += images[-1].shape[0]
+            if total >= num:
+                break
+        return np.concatenate(images, axis=0)[:num]
+
+    paths, _ = GenerateData._get_path_label(config['train_dir'], config.get('manifest_dir'),
+                                            config.get('manifest_workers', 16))
+    paths = [path for id_paths in paths for path in id_paths]
+    rng = np.random.RandomState(seed)
+    paths = [paths[i] for i in rng.choice(len(paths), min(num, len(paths)), replace=False)]
+    return np.stack([decode_image(tf.io.read_file(path), config['image_size']).numpy() for path in paths])
+
+
+def check_support(formats, quantize=None):
+    """
+        fail before exporting anything if this tf version can not write one of the formats
+    """
+    if 'frozen' in formats:
+        try:
+            from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2  # noqa
+            from tensorflow.tools.graph_transforms import TransformGraph  # noqa
+        except ImportError as e:
+            raise RuntimeError('frozen graph export needs convert_variables_to_constants_v2 and graph_transforms '
+                               '(TF 1.14+ with tensorflow.tools), found TF {}: {}'.format(tf.__version__, e))
+    if 'tflite' in formats:
+        if not hasattr(tf.compat.v2.lite.TFLiteConverter, 'from_concrete_functions'):
+            raise RuntimeError('tflite export needs TFLiteConverter.from_concrete_functions, '
+                               'found TF {}'.format(tf.__version__))
+        if quantize == 'fp16' and not (hasattr(tf.lite, 'TargetSpec') and
+                                       hasattr(tf.lite.TargetSpec(), 'supported_types')):
+            raise RuntimeError('tflite fp16 quantization needs TargetSpec.supported_types (TF 1.15+), '
+                               'found TF {}'.format(tf.__version__))
+        if quantize == 'int8' and not hasattr(tf.lite.OpsSet, 'TFLITE_BUILTINS_INT8'):
+            raise RuntimeError('tflite int8 quantization needs OpsSet.TFLITE_BUILTINS_INT8, '
+                               'found TF {}'.format(tf.__version__))
+
+
+def export_saved_model(module, export_dir):
+    tf.saved_model.save(module, export_dir, signatures={'serving_default': module.serve})
+    print('SavedModel written to {}'.format(export_dir))
+
+
+def export_frozen_graph(module, pb_path):
+    """
+        variables converted to constants, then constant folded and batch norms folded into the convs
+    :return: input tensor name, output tensor name
+    """
+    from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    frozen = convert_variables_to_constants_v2(module.serve.get_concrete_function())
+    input_name = frozen.inputs[0].name.split(':')[0]
+    output_name = frozen.outputs[0].name.split(':')[0]
+    graph_def = TransformGraph(frozen.graph.as_graph_def(), [input_name], [output_name],
+                               ['fold_constants(ignore_errors=true)', 'fold_batch_norms', 'fold_old_batch_norms',
+                                'strip_unused_nodes'])
+    tf.io.write_graph(graph_def, os.path.dirname(pb_path), os.path.basename(pb_path), as_text=False)
+    print('Frozen graph written to {}, input: {}, output: {}'.format(pb_path, input_name, output_name))
+    return input_name + ':0', output_name + ':0'
+
+
+def export_tflite(module, tflite_path, quantize=None, calib_images=None):
+    """
+    :param quantize: None, 'fp16' (float16 weights) or 'int8' (int8 weights and activations)
+    :param calib_images: representative images of the int8 activation ranges
+    """
+    converter = tf.compat.v2.lite.TFLiteConverter.from_concrete_functions([module.serve.get_concrete_function()])
+    if quantize == 'fp16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        def representative_dataset():
+            for image in calib_images:
+                yield [image[None].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantize is not None:
+        raise ValueError('Invalid quantize type')
+    with open(tflite_path, 'wb') as f:
+        f.write(converter.convert())
+    print('TFLite model written to {}'.format(tflite_path))
+
+
+def _timed(fn, images, repeat=3):
+    """
+        run fn on one image at a time
+    :return: embeddings, ms per image (best of repeat)
+    """
+    fn(images[:1])  # warm up
+    best = float('inf')
+    embs = None
+    for _ in range(repeat):
+        start = time.time()
+        embs = np.concatenate([fn(images[i:i + 1]) for i in range(images.shape[0])], axis=0)
+        best = min(best, (time.time() - start) / images.shape[0] * 1000)
+    return embs, best
+
+
+def _report(name, ref, embs, latency):
+    embs = embs / np.linalg.norm(embs, axis=-1, keepdims=True)
+    cos = np.sum(ref * embs, axis=-1)
+    print('{:<16}{:>14.6f}{:>12.6f}{:>12.3f}'.format(name, np.max(np.abs(ref - embs)), np.min(cos), latency))
+
+
+def check(model, images, saved_model_dir=None, pb_path=None, tensor_names=None, tflite_path=None):
+    """
+        parity (max abs diff and min cos against the checkpoint embeddings) and batch 1 latency of each export
+    """
+    ref, latency = _timed(lambda x: get_embeddings(model, x).numpy(), images)
+    print('{:<16}{:>14}{:>12}{:>12}'.format('model', 'max abs diff', 'min cos', 'ms/image'))
+    _report('checkpoint', ref, ref, latency)
+
+    if saved_model_dir:
+        serve = tf.compat.v2.saved_model.load(saved_model_dir).signatures['serving_default']
+        embs, latency = _timed(lambda x: serve(images=tf.constant(x))['embeddings'].numpy(), images)
+        _report('saved_model', ref, embs, latency)
+
+    if pb_path:
+        graph_def = tf.compat.v1.GraphDef()
+        with open(pb_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        with tf.compat.v1.Session(graph=graph) as sess:
+            embs, latency = _timed(lambda x: sess.run(tensor_names[1], {tensor_names[0]: x}), images)
+        _report('frozen_graph', ref, embs, latency)
+
+    if tflite_path:
+        interpreter = tf.lite.Interpreter(model_path=tflite_path)
+        input_index = interpreter.get_input_details()[0]['index']
+        interpreter.resize_tensor_input(input_index, (1,) + images.shape[1:])
+        interpreter.allocate_tensors()
+        output_index = interpreter.get_output_details()[0]['index']
+
+        def run(x):
+            interpreter.set_tensor(input_index, x.astype(np.float32))
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index).copy()
+
+        embs, latency = _timed(run, images)
+        _report('tflite', ref, embs, latency)
+
+
 def parse_args(argv):
-    parser = argparse.ArgumentParser(description='Train face network')
+    parser = argparse.ArgumentParser(description='Export the embedding model.')
     parser.add_argument('--config_path', type=str, help='path to config path', default='configs/config.yaml')
+    parser.add_argument('--output_dir', type=str, help='default: <ckpt_dir>/export', default=None)
+    parser.add_argument('--formats', type=str, nargs='*', choices=['saved_model', 'frozen', 'tflite'],
+                        default=['saved_model', 'frozen', 'tflite'])
+    parser.add_argument('--quantize', type=str, choices=['fp16', 'int8'], default=None, help='tflite quantization')
+    parser.add_argument('--num_calib', type=int, default=200, help='train images to calibrate int8 on')
+    parser.add_argument('--fuse_bn', action='store_true', help='fold batch norms into the convs before exporting')
+    parser.add_argument('--num_check', type=int, default=32, help='train images of the parity check, 0 to skip')
 
     args = parser.parse_args(argv)
 
     return args
 
 
-args = parse_args(sys.argv[1:])
+def main():
+    args = parse_args(sys.argv[1:])
+    check_support(args.formats, args.quantize)
+
+    with open(args.config_path) as cfg:
+        config = yaml.load(cfg, Loader=yaml.FullLoader)
+    model = MyModel(ResNet_v1_50, embedding_size=config['embedding_size'])
+    ckpt_dir = os.path.expanduser(config['ckpt_dir'])
+    ckpt = tf.train.Checkpoint(backbone=model.backbone)
+    ckpt.restore(tf.train.latest_checkpoint(ckpt_dir)).expect_partial()
+    print("Restored from {}".format(tf.train.latest_checkpoint(ckpt_dir)))
+    # build the backbone variables before tracing
+    get_embeddings(model, tf.zeros((1, config['image_size'], config['image_size'], 3)))
+
+    output_dir = os.path.expanduser(args.output_dir) if args.output_dir else os.path.join(ckpt_dir, 'export')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    backbone = model.backbone
+    if args.fuse_bn:
+        # fuse a separate copy, the parity check still runs against the unfused checkpoint
+        fused = MyModel(ResNet_v1_50, embedding_size=config['embedding_size'])
+        tf.train.Checkpoint(backbone=fused.backbone).restore(tf.train.latest_checkpoint(ckpt_dir)).expect_partial()
+        backbone = fused.backbone
+        backbone(tf.zeros((1, config['image_size'], config['image_size'], 3)), training=False)
+        backbone.fuse()
+    module = EmbeddingModule(backbone, config['image_size'])
 
-with open(args.config_path) as cfg:
-    config = yaml.load(cfg, Loader=yaml.FullLoader)
-gd = GenerateData(config)
-train_data, _ = gd.get_train_data()
-model = MyModel(ResNet_v1_50, embedding_size=config['embedding_size'])
+    saved_model_dir = pb_path = tensor_names = tflite_path = None
+    if 'saved_model' in args.formats:
+        saved_model_dir = os.path.join(output_dir, 'saved_model')
+        export_saved_model(module, saved_model_dir)
+    if 'frozen' in args.formats:
+        pb_path = os.path.join(output_dir, 'frozen.pb')
+        tensor_names = export_frozen_graph(module, pb_path)
+    if 'tflite' in args.formats:
+        tflite_path = os.path.join(output_dir, 'model{}.tflite'.format('_' + args.quantize if args.quantize else ''))
+        calib_images = sample_images(config, args.num_calib, seed=0) if args.quantize == 'int8' else None
+        export_tflite(module, tflite_path, args.quantize, calib_images)
 
-ckpt_dir = os.path.expanduser(config['ckpt_dir'])
-ckpt = tf.train.Checkpoint(backbone=model.backbone)
-ckpt.restore(tf.train.latest_checkpoint(ckpt_dir)).expect_partial()
-print("Restored from {}".format(tf.train.latest_checkpoint(ckpt_dir)))
+    if args.num_check > 0:
+        check(model, sample_images(config, args.num_check, seed=1), saved_model_dir, pb_path, tensor_names,
+              tflite_path)
 
-# print(tf.executing_eagerly())
-for img, _ in train_data.take(1):
-    _ = model(img)
 
-    pb_dir = os.path.join(ckpt_dir, 'pb')
-    tf.saved_model.save(model, pb_dir)
-    loaded = tf.compat.v2.saved_model.load(pb_dir)
-    test, _, _ = loaded.call(img)
-    print(test)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from recognition.gallery.codec import CompressedIndex, Int8Codec, PQCodec
+from recognition.gallery.index import FlatIndex, IVFIndex
+
+
+def _normalize(x):
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def make_gallery(num, num_queries, embedding_size, seed=0):
+    """
+        synthetic gallery with cluster structure, queries are noisy copies of gallery entries
+    :return: gallery, queries, l2 normalized
+    """
+    rng = np.random.RandomState(seed)
+    centers = _normalize(rng.randn(max(num // 100, 1), embedding_size).astype(np.float32))
+    gallery = centers[rng.randint(centers.shape[0], size=num)]
+    gallery = _normalize(gallery + 0.5 / np.sqrt(embedding_size) * rng.randn(num, embedding_size).astype(np.float32))
+    queries = gallery[rng.randint(num, size=num_queries)]
+    queries = _normalize(queries + 0.3 / np.sqrt(embedding_size) *
+                         rng.randn(num_queries, embedding_size).astype(np.float32))
+    return gallery, queries
+
+
+def recall_at_k(ids, gt_ids, k):
+    """
+        fraction of the exact top k found in the approximate top k
+    """
+    hits = [len(np.intersect1d(ids[i, :k], gt_ids[i, :k])) for i in range(ids.shape[0])]
+    return np.sum(hits) / (ids.shape[0] * k)
+
+
+def _timed_search(index, queries, k, **kwargs):
+    start = time.time()
+    scores, ids = index.search(queries, k, **kwargs)
+    elapsed = time.time() - start
+    return ids, queries.shape[0] / elapsed, elapsed / queries.shape[0] * 1000
+
+
+def _print_row(name, recall, qps, latency, memory):
+    print('{:<20}{:>10.4f}{:>12.1f}{:>12.3f}{:>12.1f}'.format(name, recall, qps, latency, memory / 1024 / 1024))
+
+
+def _add_blocks(index, gallery, block_size=65536):
+    """
+        add the gallery block by block, a memmap is never read into memory at once
+    """
+    for begin in range(0, gallery.shape[0], block_size):
+        index.add(np.asarray(gallery[begin:begin + block_size], dtype=np.float32))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the gallery index.')
+    parser.add_argument('--emb_path', type=str, default=None,
+                        help='.npy of l2 normalized gallery embeddings, synthetic if not set')
+    parser.add_argument('--num', type=int, default=200000, help='synthetic gallery size')
+    parser.add_argument('--num_queries', type=int, default=2000)
+    parser.add_argument('--embedding_size', type=int, default=512)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', type=int, nargs='*', default=[1, 4, 16, 64])
+    parser.add_argument('--pq_m', type=int, nargs='*', default=[32, 64], help='PQ sub-vector numbers')
+    parser.add_argument('--rerank_k', type=int, default=100, help='candidates reranked with full precision')
+    parser.add_argument('--num_threads', type=int, default=None)
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if args.emb_path:
+        gallery = np.load(args.emb_path, mmap_mode='r')
+        rng = np.random.RandomState(0)
+        queries = np.asarray(gallery[np.sort(rng.choice(gallery.shape[0], args.num_queries, replace=False))])
+    else:
+        gallery, queries = make_gallery(args.num, args.num_queries, args.embedding_size)
+    queries = np.asarray(queries, dtype=np.float32)
+
+    flat = FlatIndex(gallery.shape[1], num_threads=args.num_threads)
+    _add_blocks(flat, gallery)
+    gt_ids, qps, latency = _timed_search(flat, queries, args.k)
+    print('gallery: {}, queries: {}, k: {}'.format(gallery.shape[0], queries.shape[0], args.k))
+    print('{:<20}{:>10}{:>12}{:>12}{:>12}'.format('index', 'recall@k', 'queries/s', 'ms/query', 'memory MB'))
+    _print_row('flat', 1.0, qps, latency, flat.memory_bytes())
+
+    ivf = IVFIndex(gallery.shape[1], nlist=args.nlist, num_threads=args.num_threads)
+    ivf.train(gallery)
+    _add_blocks(ivf, gallery)
+    for nprobe in args.nprobe:
+        ids, qps, latency = _timed_search(ivf, queries, args.k, nprobe=nprobe)
+        _print_row('ivf nprobe={}'.format(nprobe), recall_at_k(ids, gt_ids, args.k), qps, latency,
+                   ivf.memory_bytes())
+
+    codecs = [('int8', Int8Codec(gallery.shape[1]))]
+    codecs += [('pq m={}'.format(m), PQCodec(gallery.shape[1], m=m)) for m in args.pq_m]
+    for name, codec in codecs:
+        index = CompressedIndex(codec, num_threads=args.num_threads)
+        index.train(gallery)
+        _add_blocks(index, gallery)
+        ids, qps, latency = _timed_search(index, queries, args.k)
+        _print_row(name, recall_at_k(ids, gt_ids, args.k), qps, latency, index.memory_bytes())
+        # full precision embeddings stay in the --emb_path memmap, only the candidate rows are read to rerank
+        index.set_full_embeddings(gallery)
+        ids, qps, latency = _timed_search(index, queries, args.k, rerank_k=args.rerank_k)
+        _print_row('{} +rerank'.format(name), recall_at_k(ids, gt_ids, args.k), qps, latency, index.memory_bytes())
+
+
+if __name__ == '__main__':
+    main()
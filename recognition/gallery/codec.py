@@ -0,0 +1,202 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from recognition.gallery.index import _merge_top_k, kmeans
+
+
+class Int8Codec:
+    """
+        symmetric per-dimension scalar quantization, 1 byte per dimension
+    """
+
+    def __init__(self, embedding_size=512):
+        self.embedding_size = embedding_size
+        self.scale = None
+
+    @property
+    def code_size(self):
+        return self.embedding_size
+
+    def train(self, embs, block_size=65536):
+        # blockwise, embs may be a memmap larger than memory
+        scale = np.zeros((self.embedding_size,), dtype=np.float32)
+        for begin in range(0, embs.shape[0], block_size):
+            block = np.asarray(embs[begin:begin + block_size], dtype=np.float32)
+            scale = np.maximum(scale, np.max(np.abs(block), axis=0))
+        self.scale = np.maximum(scale / 127, 1e-12).astype(np.float32)
+
+    def encode(self, embs):
+        codes = np.round(np.asarray(embs, dtype=np.float32) / self.scale)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scale
+
+    def lookup_table(self, queries):
+        # q . (code * scale) == (q * scale) . code
+        return np.asarray(queries, dtype=np.float32) * self.scale
+
+    def score(self, table, codes):
+        """
+            asymmetric inner products of the queries (as lookup tables) against codes
+        :return: shape=[N, len(codes)]
+        """
+        return np.dot(table, codes.astype(np.float32).T)
+
+
+class PQCodec:
+    """
+        product quantization: the embedding is split into m sub-vectors, each one is
+        replaced by the index of its nearest of ks trained sub-centroids, m bytes per embedding
+    """
+
+    def __init__(self, embedding_size=512, m=64, ks=256):
+        assert (embedding_size % m == 0), 'embedding_size must be divisible by m'
+        assert (ks <= 256), 'codes are stored as uint8'
+        self.embedding_size = embedding_size
+        self.m = m
+        self.ks = ks
+        self.sub_size = embedding_size // m
+        self.codebooks = None
+
+    @property
+    def code_size(self):
+        return self.m
+
+    def _split(self, embs):
+        return np.asarray(embs, dtype=np.float32).reshape(-1, self.m, self.sub_size)
+
+    def train(self, embs, iters=20, sample=64 * 1024):
+        if sample is not None and embs.shape[0] > sample:
+            # read only the sampled rows, embs may be a memmap larger than memory
+            embs = embs[np.sort(np.random.RandomState(0).choice(embs.shape[0], sample, replace=False))]
+        sub = self._split(embs)
+        self.codebooks = np.stack([kmeans(sub[:, j], self.ks, iters=iters, seed=j, sample=sample)
+                                   for j in range(self.m)])
+
+    def encode(self, embs, block_size=65536):
+        sub = self._split(embs)
+        codes = np.zeros((sub.shape[0], self.m), dtype=np.uint8)
+        c_square = np.sum(np.square(self.codebooks), axis=2)
+        for begin in range(0, sub.shape[0], block_size):
+            block = sub[begin:begin + block_size]
+            for j in range(self.m):
+                dist = c_square[j][None, :] - 2 * np.dot(block[:, j], self.codebooks[j].T)
+                codes[begin:begin + block_size, j] = np.argmin(dist, axis=1)
+        return codes
+
+    def decode(self, codes):
+        return self.codebooks[np.arange(self.m)[None, :], codes.astype(np.int64)].reshape(-1, self.embedding_size)
+
+    def lookup_table(self, queries):
+        """
+        :return: inner product of every query sub-vector with every sub-centroid, shape=[N, m, ks]
+        """
+        return np.einsum('nmd,mkd->nmk', self._split(queries), self.codebooks)
+
+    def score(self, table, codes):
+        scores = np.zeros((table.shape[0], codes.shape[0]), dtype=np.float32)
+        # one contiguous row of codes per sub-vector, so each lookup is a plain gather
+        codes = np.ascontiguousarray(codes.T).astype(np.intp)
+        for j in range(self.m):
+            scores += table[:, j].take(codes[j], axis=1)
+        return scores
+
+
+class CompressedIndex:
+    """
+        exhaustive search over codes with asymmetric distance computation (raw queries against codes),
+        optionally reranking the best candidates with full precision embeddings.
+        added codes are concatenated once, on the next search
+    """
+
+    def __init__(self, codec, block_size=16384, num_threads=None):
+        self.codec = codec
+        self.block_size = block_size
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.codes = None
+        self.ids = np.zeros((0,), dtype=np.int64)
+        self.pending = []   # (codes, ids) of the adds not merged yet
+        self.num = 0
+        self.full_embs = None
+
+    def __len__(self):
+        return self.num
+
+    def train(self, embs):
+        self.codec.train(embs)
+
+    def add(self, embs, ids=None):
+        codes = self.codec.encode(embs)
+        if ids is None:
+            ids = np.arange(self.num, self.num + codes.shape[0])
+        self.pending.append((codes, np.asarray(ids, dtype=np.int64)))
+        self.num += codes.shape[0]
+
+    def _merge_pending(self):
+        if not self.pending:
+            return
+        codes = [p[0] for p in self.pending]
+        self.codes = np.concatenate(codes if self.codes is None else [self.codes] + codes, axis=0)
+        self.ids = np.concatenate([self.ids] + [p[1] for p in self.pending])
+        self.pending = []
+
+    def set_full_embeddings(self, embs):
+        """
+        :param embs: full precision embeddings in insertion order, e.g. a memmap on disk, None to disable rerank
+        """
+        self.full_embs = embs
+
+    def memory_bytes(self):
+        self._merge_pending()
+        return self.codes.nbytes + self.ids.nbytes
+
+    def _search_block(self, queries, k):
+        table = self.codec.lookup_table(queries)
+        best_scores = np.full((queries.shape[0], 0), -np.inf, dtype=np.float32)
+        best_idx = np.zeros((queries.shape[0], 0), dtype=np.int64)
+        for begin in range(0, len(self), self.block_size):
+            sims = self.codec.score(table, self.codes[begin:begin + self.block_size])
+            kk = min(k, sims.shape[1])
+            part = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+            scores = np.concatenate((best_scores, np.take_along_axis(sims, part, axis=1)), axis=1)
+            idx = np.concatenate((best_idx, part + begin), axis=1)
+            best_scores, best_idx = _merge_top_k(scores, idx, k)
+        return best_scores, best_idx
+
+    def _rerank(self, queries, idx, k):
+        scores = np.zeros(idx.shape, dtype=np.float32)
+        for i in range(queries.shape[0]):
+            rows = np.sort(idx[i])
+            sims = np.dot(np.asarray(self.full_embs[rows], dtype=np.float32), queries[i])
+            scores[i] = sims[np.searchsorted(rows, idx[i])]
+        return _merge_top_k(scores, idx, k)
+
+    def search(self, queries, k=10, rerank_k=None):
+        """
+        :param queries: l2 normalized embeddings, shape=[N, D]
+        :param rerank_k: candidates per query scored from the codes and reranked with the full embeddings,
+                         needs set_full_embeddings, None to return the code scores
+        :return: scores, ids, shape=[N, k], sorted by descending score
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        self._merge_pending()
+        rerank = rerank_k is not None and self.full_embs is not None
+        num = max(rerank_k, k) if rerank else k
+
+        def search_chunk(c):
+            scores, idx = self._search_block(queries[c], num)
+            if rerank:
+                scores, idx = self._rerank(queries[c], idx, k)
+            return scores, idx
+
+        chunks = np.array_split(np.arange(queries.shape[0]), min(self.num_threads, max(queries.shape[0], 1)))
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            results = list(executor.map(search_chunk, chunks))
+        scores = np.concatenate([r[0] for r in results], axis=0)
+        idx = np.concatenate([r[1] for r in results], axis=0)
+        return scores, self.ids[idx]
@@ -0,0 +1,209 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def kmeans(x, k, iters=20, seed=0, sample=None):
+    """
+        lloyd k-means (l2) on the rows of x
+    :param sample: train on at most this many random rows
+    :return: centroids, shape=[k, D]
+    """
+    rng = np.random.RandomState(seed)
+    # sample before the cast, x may be a memmap larger than memory
+    if sample is not None and x.shape[0] > sample:
+        x = x[np.sort(rng.choice(x.shape[0], sample, replace=False))]
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(x.shape[0], k, replace=x.shape[0] < k)].copy()
+    for _ in range(iters):
+        assign = assign_nearest(x, centroids)
+        for c in range(k):
+            members = x[assign == c]
+            if members.shape[0] > 0:
+                centroids[c] = members.mean(axis=0)
+            else:
+                # restart an empty cluster from a random point
+                centroids[c] = x[rng.randint(x.shape[0])]
+    return centroids
+
+
+def assign_nearest(x, centroids, block_size=65536):
+    """
+        nearest centroid (l2) of every row
+    """
+    c_square = np.sum(np.square(centroids), axis=1)
+    assign = np.zeros(x.shape[0], dtype=np.int64)
+    for begin in range(0, x.shape[0], block_size):
+        block = x[begin:begin + block_size]
+        dist = c_square[None, :] - 2 * np.dot(block, centroids.T)
+        assign[begin:begin + block_size] = np.argmin(dist, axis=1)
+    return assign
+
+
+def _merge_top_k(scores, idx, k):
+    keep = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(scores, keep, axis=1)
+    idx = np.take_along_axis(idx, keep, axis=1)
+    order = np.argsort(-scores, axis=1, kind='mergesort')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+class FlatIndex:
+    """
+        exact inner-product search over l2 normalized embeddings,
+        queries are split over threads (numpy matmul releases the GIL), the gallery is scanned in blocks.
+        added embeddings are concatenated once, on the next search
+    """
+
+    def __init__(self, embedding_size=512, block_size=65536, num_threads=None):
+        self.embedding_size = embedding_size
+        self.block_size = block_size
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.embs = np.zeros((0, embedding_size), dtype=np.float32)
+        self.ids = np.zeros((0,), dtype=np.int64)
+        self.pending = []   # (embs, ids) of the adds not merged yet
+        self.num = 0
+
+    def __len__(self):
+        return self.num
+
+    def add(self, embs, ids=None):
+        embs = np.asarray(embs, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self.num, self.num + embs.shape[0])
+        self.pending.append((embs, np.asarray(ids, dtype=np.int64)))
+        self.num += embs.shape[0]
+
+    def _merge_pending(self):
+        if not self.pending:
+            return
+        self.embs = np.concatenate([self.embs] + [p[0] for p in self.pending], axis=0)
+        self.ids = np.concatenate([self.ids] + [p[1] for p in self.pending])
+        self.pending = []
+
+    def memory_bytes(self):
+        self._merge_pending()
+        return self.embs.nbytes + self.ids.nbytes
+
+    def _search_block(self, queries, k):
+        best_scores = np.full((queries.shape[0], 0), -np.inf, dtype=np.float32)
+        best_idx = np.zeros((queries.shape[0], 0), dtype=np.int64)
+        for begin in range(0, len(self), self.block_size):
+            sims = np.dot(queries, self.embs[begin:begin + self.block_size].T)
+            kk = min(k, sims.shape[1])
+            part = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+            scores = np.concatenate((best_scores, np.take_along_axis(sims, part, axis=1)), axis=1)
+            idx = np.concatenate((best_idx, part + begin), axis=1)
+            best_scores, best_idx = _merge_top_k(scores, idx, k)
+        return best_scores, best_idx
+
+    def search(self, queries, k=10):
+        """
+        :param queries: l2 normalized embeddings, shape=[N, D]
+        :return: scores, ids, shape=[N, k], sorted by descending score
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        self._merge_pending()
+        chunks = np.array_split(np.arange(queries.shape[0]), min(self.num_threads, max(queries.shape[0], 1)))
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            results = list(executor.map(lambda c: self._search_block(queries[c], k), chunks))
+        scores = np.concatenate([r[0] for r in results], axis=0)
+        idx = np.concatenate([r[1] for r in results], axis=0)
+        return scores, self.ids[idx]
+
+
+class IVFIndex:
+    """
+        inverted file index: gallery embeddings are bucketed by a coarse k-means quantizer,
+        a query only scans the nprobe buckets whose centroids are closest to it.
+        the buckets are stored contiguously, sorted by centroid: bucket c is embs[offsets[c]:offsets[c + 1]],
+        added embeddings are merged in on the next search
+    """
+
+    def __init__(self, embedding_size=512, nlist=1024, nprobe=16, num_threads=None):
+        self.embedding_size = embedding_size
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.centroids = None
+        self.embs = np.zeros((0, embedding_size), dtype=np.float32)
+        self.ids = np.zeros((0,), dtype=np.int64)
+        self.offsets = np.zeros((nlist + 1,), dtype=np.int64)
+        self.pending = []   # (assign, embs, ids) of the adds not merged yet
+        self.num = 0
+
+    def __len__(self):
+        return self.num
+
+    def train(self, embs, iters=20, sample=256 * 1024):
+        self.centroids = kmeans(embs, self.nlist, iters=iters, sample=sample)
+
+    def add(self, embs, ids=None):
+        assert (self.centroids is not None), 'train the index first'
+        embs = np.asarray(embs, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self.num, self.num + embs.shape[0])
+        ids = np.asarray(ids, dtype=np.int64)
+        self.pending.append((assign_nearest(embs, self.centroids), embs, ids))
+        self.num += embs.shape[0]
+
+    def _merge_pending(self):
+        """
+            one stable sort by bucket over the stored and the pending embeddings
+        """
+        if not self.pending:
+            return
+        old_assign = np.repeat(np.arange(self.nlist), np.diff(self.offsets))
+        assign = np.concatenate([old_assign] + [p[0] for p in self.pending])
+        order = np.argsort(assign, kind='stable')
+        self.embs = np.concatenate([self.embs] + [p[1] for p in self.pending], axis=0)[order]
+        self.ids = np.concatenate([self.ids] + [p[2] for p in self.pending])[order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=self.nlist)))).astype(np.int64)
+        self.pending = []
+
+    def memory_bytes(self):
+        self._merge_pending()
+        return self.embs.nbytes + self.ids.nbytes + self.offsets.nbytes + self.centroids.nbytes
+
+    def _search_one(self, query, probes, k):
+        begins = self.offsets[probes]
+        ends = self.offsets[probes + 1]
+        scores = np.full(k, -np.inf, dtype=np.float32)
+        ret_ids = np.full(k, -1, dtype=np.int64)
+        if np.sum(ends - begins) > 0:
+            # buckets are slices of the contiguous storage, only the similarities are concatenated
+            sims = np.concatenate([np.dot(self.embs[b:e], query) for b, e in zip(begins, ends)])
+            pos = np.concatenate([np.arange(b, e) for b, e in zip(begins, ends)])
+            kk = min(k, sims.shape[0])
+            top = np.argpartition(-sims, kk - 1)[:kk]
+            top = top[np.argsort(-sims[top], kind='mergesort')]
+            scores[:kk] = sims[top]
+            ret_ids[:kk] = self.ids[pos[top]]
+        return scores, ret_ids
+
+    def _search_block(self, queries, k, nprobe):
+        # same l2 metric as the assignment, the centroids are means and not normalized
+        c_square = np.sum(np.square(self.centroids), axis=1)
+        probes = np.argsort(c_square[None, :] - 2 * np.dot(queries, self.centroids.T), axis=1)[:, :nprobe]
+        scores = np.zeros((queries.shape[0], k), dtype=np.float32)
+        ids = np.zeros((queries.shape[0], k), dtype=np.int64)
+        for i in range(queries.shape[0]):
+            scores[i], ids[i] = self._search_one(queries[i], probes[i], k)
+        return scores, ids
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        :param queries: l2 normalized embeddings, shape=[N, D]
+        :param nprobe: buckets scanned per query, default self.nprobe
+        :return: scores, ids, shape=[N, k], sorted by descending score, id -1 if less than k found
+        """
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        queries = np.asarray(queries, dtype=np.float32)
+        self._merge_pending()
+        chunks = np.array_split(np.arange(queries.shape[0]), min(self.num_threads, max(queries.shape[0], 1)))
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            results = list(executor.map(lambda c: self._search_block(queries[c], k, nprobe), chunks))
+        return np.concatenate([r[0] for r in results], axis=0), np.concatenate([r[1] for r in results], axis=0)
@@ -23,17 +23,35 @@ def center_loss(features, label, centers, alpha):
     return loss, centers
 
 
+# renamed from tensor_scatter_update in newer tf
+_tensor_scatter_nd_update = getattr(tf, 'tensor_scatter_nd_update', None) or tf.tensor_scatter_update
+
+
 def arcface_loss(x, normx_cos, labels, m1, m2, m3, s):
+    """
+        combined margin loss, logit of the target class: s * (cos(m1 * theta + m3) - m2), others: s * cos(theta)
+        only the B target logits get the margin: they are gathered, changed and scattered back,
+        no [B, C] one hot mask, acos or cos
+    :param x: prelogits, shape=[B, D]
+    :param normx_cos: ||x|| * cos(theta), shape=[B, C]
+    """
     norm_x = tf.norm(x, axis=1, keepdims=True)
     cos_theta = normx_cos / norm_x
-    theta = tf.acos(cos_theta)
-    mask = tf.one_hot(labels, depth=normx_cos.shape[-1])
-    zeros = tf.zeros_like(mask)
-    cond = tf.where(tf.greater(theta * m1 + m3, math.pi), zeros, mask)      # 为保证cos()单调递减，需限制角度小于pi：若theta*m1+m3>pi, cond=zeros; else: cond=mask
-    cond = tf.cast(cond, dtype=tf.bool)
-    m1_theta_plus_m3 = tf.where(cond, theta * m1 + m3, theta)
-    cos_m1_theta_plus_m3 = tf.cos(m1_theta_plus_m3)
-    prelogits = tf.where(cond, cos_m1_theta_plus_m3 - m2, cos_m1_theta_plus_m3) * s
+    labels = tf.cast(labels, tf.int32)
+    idx = tf.stack((tf.range(tf.shape(labels)[0]), labels), axis=1)
+    cos_t = tf.gather_nd(cos_theta, idx)
+    if m1 == 1:
+        # cos(theta + m3) = cos(theta) * cos(m3) - sin(theta) * sin(m3), sin(theta) >= 0 for theta in [0, pi]
+        sin_t = tf.sqrt(tf.maximum(1 - tf.square(cos_t), 1e-12))
+        cos_margin = cos_t * math.cos(m3) - sin_t * math.sin(m3)
+        # theta + m3 <= pi keeps cos() monotonically decreasing
+        valid = tf.greater_equal(cos_t, -math.cos(m3))
+    else:
+        theta = tf.acos(tf.clip_by_value(cos_t, -1 + 1e-7, 1 - 1e-7))
+        cos_margin = tf.cos(theta * m1 + m3)
+        valid = tf.less_equal(theta * m1 + m3, math.pi)     # 为保证cos()单调递减，需限制角度小于pi
+    target = tf.where(valid, cos_margin - m2, cos_t)
+    prelogits = _tensor_scatter_nd_update(cos_theta, idx, target) * s
     # from_logits=False: loss = -log(0.9/(0.9+0.1))     # from_logits=True: loss = -log(exp(0.9)/(exp(0.9)+exp(0.1)))
     cce = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
     loss = cce(labels, prelogits)
@@ -50,6 +68,61 @@ def triplet_loss(anchor_emb, pos_emb, neg_emb, alpha):
     return loss
 
 
+def _pairwise_distances(embs):
+    # squared euclidean distance of every two rows, shape=[B, B]
+    dot = tf.matmul(embs, embs, transpose_b=True)
+    square = tf.linalg.diag_part(dot)
+    dist = tf.expand_dims(square, 1) - 2.0 * dot + tf.expand_dims(square, 0)
+    return tf.maximum(dist, 0.0)
+
+
+def select_triplets(embs, labels, mining='semi_hard'):
+    """
+        select triplets inside a batch
+        semi_hard: every (anchor, pos) pair, the closest neg farther than pos,
+                   the farthest neg if there is no such neg (FaceNet)
+        hard: every anchor, the farthest pos and the closest neg (batch hard)
+    :return: anchor, pos, neg indices of the batch
+    """
+    dist = tf.stop_gradient(_pairwise_distances(embs))
+    big = tf.ones_like(dist) * 1e9
+    same = tf.equal(tf.expand_dims(labels, 1), tf.expand_dims(labels, 0))
+    not_self = tf.logical_not(tf.cast(tf.eye(tf.shape(labels)[0]), tf.bool))
+    pos_mask = tf.logical_and(same, not_self)
+    neg_mask = tf.logical_not(same)
+
+    if mining == 'hard':
+        anchor = tf.range(tf.shape(labels)[0], dtype=tf.int64)
+        pos = tf.argmax(tf.where(pos_mask, dist, -big), axis=1)
+        neg = tf.argmin(tf.where(neg_mask, dist, big), axis=1)
+        valid = tf.logical_and(tf.reduce_any(pos_mask, axis=1), tf.reduce_any(neg_mask, axis=1))
+    elif mining == 'semi_hard':
+        pairs = tf.where(pos_mask)
+        anchor = pairs[:, 0]
+        pos = pairs[:, 1]
+        pos_dist = tf.gather_nd(dist, pairs)
+        an_dist = tf.gather(dist, anchor)
+        an_mask = tf.gather(neg_mask, anchor)
+        an_big = tf.gather(big, anchor)
+        semi_mask = tf.logical_and(an_mask, tf.greater(an_dist, tf.expand_dims(pos_dist, 1)))
+        semi_neg = tf.argmin(tf.where(semi_mask, an_dist, an_big), axis=1)
+        easy_neg = tf.argmax(tf.where(an_mask, an_dist, -an_big), axis=1)
+        neg = tf.where(tf.reduce_any(semi_mask, axis=1), semi_neg, easy_neg)
+        valid = tf.reduce_any(an_mask, axis=1)
+    else:
+        raise ValueError('Invalid mining type')
+
+    return tf.boolean_mask(anchor, valid), tf.boolean_mask(pos, valid), tf.boolean_mask(neg, valid)
+
+
+def online_triplet_loss(embs, labels, alpha, mining='semi_hard'):
+    anchor, pos, neg = select_triplets(embs, labels, mining)
+    loss = tf.cond(tf.size(anchor) > 0,
+                   lambda: triplet_loss(tf.gather(embs, anchor), tf.gather(embs, pos), tf.gather(embs, neg), alpha),
+                   lambda: tf.constant(0.0))
+    return loss, tf.size(anchor)
+
+
 def parse_args(argv):
     import argparse
     parser = argparse.ArgumentParser(description='define losses.')
@@ -8,7 +8,7 @@ tf.enable_eager_execution()
 class NormDense(tf.keras.layers.Layer):
 
     def __init__(self, classes=1000):
-        super(NormDense, self).__init__()
+        super(NormDense, self).__init__(dtype='float32')     # normalization stays float32 under mixed precision
         self.classes = classes
 
     def build(self, input_shape):
@@ -21,22 +21,84 @@ class NormDense(tf.keras.layers.Layer):
                                  initializer='random_normal', trainable=True)
 
     def call(self, inputs, **kwargs):
+        inputs = tf.cast(inputs, tf.float32)
         norm_w = tf.nn.l2_normalize(self.w, axis=0)     # norm_w = w/sqrt(sum(w**2))
         x = tf.matmul(inputs, norm_w)
         # print(self.w.shape, inputs.shape, norm_w.shape)             # ->(512, 221) (16, 512) (512, 221)
         return x
 
 
+class PartialFC(tf.keras.layers.Layer):
+    """
+        class center sampling (Partial FC) for margin losses with a huge number of classes
+        each step only the centers of the classes in the batch plus random negative centers are used,
+        the centers are not trainable variables, so the optimizer keeps no slots for them:
+        the trainer gathers the sampled rows, takes their gradient and applies update() (plain sgd) to those rows
+    """
+
+    def __init__(self, classes=1000, embedding_size=512, sample_rate=0.1):
+        super(PartialFC, self).__init__(dtype='float32')
+        self.classes = classes
+        self.num_sample = max(int(classes * sample_rate), 1)
+        # one row per class (NormDense keeps one column per class) so rows can be gathered and scattered
+        self.w = self.add_weight(name='partial_fc_w', shape=(classes, embedding_size),
+                                 initializer='random_normal', trainable=False)
+
+    def sample(self, labels):
+        """
+            O(num_sample) per step: the batch classes plus uniformly drawn negative ids, duplicates removed
+            (so slightly fewer than num_sample centers may be used)
+        :param labels: class ids of the batch
+        :return: sampled class ids (the classes of the batch first), labels as positions in the sampled ids
+        """
+        labels = tf.cast(labels, tf.int32)
+        positive, label_pos = tf.unique(labels)
+        num_neg = tf.maximum(self.num_sample - tf.size(positive), 0)
+        negative = tf.random.uniform((num_neg,), maxval=self.classes, dtype=tf.int32)
+        # unique keeps the first occurrence, so the positives stay at [0, len(positive)) in batch order
+        index, _ = tf.unique(tf.concat([positive, negative], axis=0))
+        return index, label_pos
+
+    def call(self, inputs, sub_w=None, **kwargs):
+        """
+        :param sub_w: gathered rows of self.w, watched by the tape
+        :return: ||x|| * cos(theta) against the sampled centers, shape=[B, num_sample]
+        """
+        inputs = tf.cast(inputs, tf.float32)
+        norm_w = tf.nn.l2_normalize(sub_w, axis=1)
+        return tf.matmul(inputs, norm_w, transpose_b=True)
+
+    def update(self, index, grad, learning_rate):
+        return tf.compat.v1.scatter_sub(self.w, index, learning_rate * grad)
+
+
 class MyModel(tf.keras.Model):
-    def __init__(self, backbone, embedding_size=512, classes=1000):
+    def __init__(self, backbone, embedding_size=512, classes=1000, compute_dtype=tf.float32, sample_rate=1.0):
+        """
+        :param compute_dtype: dtype the backbone runs in, see common/precision.py, the heads and outputs stay float32
+        :param sample_rate: < 1 replaces the dense heads by PartialFC sampling this fraction of the class centers,
+                            call() then returns None for dense and norm_dense
+        """
         super(MyModel, self).__init__()
+        self.compute_dtype = compute_dtype
         self.backbone = backbone(include_top=True, embedding_size=embedding_size)
-        self.dense = tf.keras.layers.Dense(classes)
-        self.norm_dense = NormDense(classes)
+        self.dense = None
+        self.norm_dense = None
+        self.partial_fc = None
+        if sample_rate < 1:
+            self.partial_fc = PartialFC(classes, embedding_size, sample_rate)
+        else:
+            self.dense = tf.keras.layers.Dense(classes, dtype='float32')
+            self.norm_dense = NormDense(classes)
 
     @tf.function
     def call(self, inputs, training=False, mask=None):
+        inputs = tf.cast(inputs, self.compute_dtype)
         prelogits = self.backbone(inputs, training=training)    # features output by backbone(resnet)
+        prelogits = tf.cast(prelogits, tf.float32)
+        if self.partial_fc is not None:
+            # the trainer computes the logits of the sampled centers
+            return prelogits, None, None
         dense = self.dense(prelogits)                           # fully connect layer to classify different person
         norm_dense = self.norm_dense(prelogits)                 # 对比self.dense: Y = X * W + B
                                                                 # self.norm_dense: Y=||X||*||W||*cos(theta) -> Y_ij=||X_i||*||W_j||*cos(theta_ij) 分别对X的行和W的列求二范数
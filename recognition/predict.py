@@ -47,14 +47,13 @@ def main():
     # for layer in tf.train.list_variables(tf.train.latest_checkpoint(ckpt_dir)):
     #     print(layer)
 
+    from recognition.score import similarity_matrix
     for img, _ in train_data.take(1):
-        embs = get_embeddings(model, img)
-        for i in range(embs.shape[0]):
-            for j in range(embs.shape[0]):
-                val = 0
-                for k in range(512):
-                    val += embs[i][k] * embs[j][k]
-                print(i, j, val)
+        embs = get_embeddings(model, img).numpy()
+        sims = similarity_matrix(embs, embs)
+        for i in range(sims.shape[0]):
+            for j in range(sims.shape[1]):
+                print(i, j, sims[i, j])
 
 
 if __name__ == '__main__':
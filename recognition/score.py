@@ -0,0 +1,117 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+from recognition.predict import get_embeddings
+
+tf.enable_eager_execution()
+
+
+def embed_dataset(model, dataset):
+    """
+        stream embeddings of a dataset
+    :param dataset: yields image batches, or (image, ...) tuples
+    :return: yield embedding blocks, numpy, shape=[batch, D]
+    """
+    for batch in dataset:
+        images = batch[0] if isinstance(batch, (tuple, list)) else batch
+        yield get_embeddings(model, images).numpy()
+
+
+def _iter_blocks(embs, block_size):
+    """
+    :param embs: array (or memmap) of embeddings, an iterable of embedding blocks,
+                 or a callable returning such an iterable (to iterate a streamed gallery more than once)
+    :return: yield (begin, block)
+    """
+    if callable(embs):
+        embs = embs()
+    if hasattr(embs, 'shape'):
+        for begin in range(0, embs.shape[0], block_size):
+            yield begin, np.asarray(embs[begin:begin + block_size], dtype=np.float32)
+    else:
+        begin = 0
+        for block in embs:
+            block = np.asarray(block, dtype=np.float32)
+            yield begin, block
+            begin += block.shape[0]
+
+
+def _check_reiterable(embs, name):
+    """
+        a side iterated once per block of the other side can not be a one-shot iterator (e.g. a generator)
+    """
+    if not callable(embs) and not hasattr(embs, 'shape') and iter(embs) is embs:
+        raise TypeError('{} is iterated more than once, pass an array, a list of blocks or a callable returning '
+                        'a new iterable, not a one-shot iterator'.format(name))
+
+
+def verify(model, images1, images2):
+    """
+        batched 1:1 verification
+    :return: cos similarity of each (images1[i], images2[i]), shape=[N]
+    """
+    emb1 = get_embeddings(model, images1)
+    emb2 = get_embeddings(model, images2)
+    return tf.reduce_sum(emb1 * emb2, axis=-1).numpy()
+
+
+def iter_similarity(queries, gallery, block_size=4096):
+    """
+        similarity blocks of queries x gallery, neither side has to fit in memory
+    :return: yield (query begin, gallery begin, block), block shape=[<=block_size, <=block_size]
+    """
+    _check_reiterable(gallery, 'gallery')
+    for q_begin, q_block in _iter_blocks(queries, block_size):
+        q_block = tf.constant(q_block)
+        for g_begin, g_block in _iter_blocks(gallery, block_size):
+            yield q_begin, g_begin, tf.matmul(q_block, g_block, transpose_b=True).numpy()
+
+
+def similarity_matrix(queries, gallery, block_size=4096):
+    """
+        N x M cos similarity matrix, computed block by block
+    :param queries: l2 normalized embeddings, shape=[N, D]
+    :param gallery: l2 normalized embeddings, shape=[M, D]
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    gallery = np.asarray(gallery, dtype=np.float32)
+    sims = np.zeros((queries.shape[0], gallery.shape[0]), dtype=np.float32)
+    for q_begin, g_begin, block in iter_similarity(queries, gallery, block_size):
+        sims[q_begin:q_begin + block.shape[0], g_begin:g_begin + block.shape[1]] = block
+    return sims
+
+
+def top_k(queries, gallery, k=5, block_size=4096):
+    """
+        top k gallery entries of each query, the gallery is streamed block by block
+        and only the running top k is kept
+    :param queries: array, iterable of blocks or callable, see _iter_blocks
+    :param gallery: array, list of blocks or callable returning an iterable of blocks (iterated once per query block),
+                    a one-shot iterator raises TypeError
+    :return: scores, indices, shape=[N, k], sorted by descending score
+    """
+    _check_reiterable(gallery, 'gallery')
+    all_scores = []
+    all_idx = []
+    for _, q_block in _iter_blocks(queries, block_size):
+        q_block = tf.constant(q_block)
+        best_scores = None
+        best_idx = None
+        for g_begin, g_block in _iter_blocks(gallery, block_size):
+            sims = tf.matmul(q_block, g_block, transpose_b=True)
+            scores, idx = tf.math.top_k(sims, k=min(k, g_block.shape[0]))
+            scores = scores.numpy()
+            idx = idx.numpy().astype(np.int64) + g_begin
+            if best_scores is not None:
+                # merge with the running top k, top_k output is sorted
+                scores = np.concatenate((best_scores, scores), axis=1)
+                idx = np.concatenate((best_idx, idx), axis=1)
+                keep = np.argsort(-scores, axis=1, kind='mergesort')[:, :k]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                idx = np.take_along_axis(idx, keep, axis=1)
+            best_scores, best_idx = scores, idx
+        all_scores.append(best_scores)
+        all_idx.append(best_idx)
+    return np.concatenate(all_scores, axis=0), np.concatenate(all_idx, axis=0)
@@ -0,0 +1,302 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from common.precision import set_policy
+from recognition.backbones.resnet_v1 import ResNet_v1_50
+from recognition.data.generate_data import decode_image
+from recognition.embedding_cache import EmbeddingCache
+from recognition.models.models import MyModel
+from recognition.predict import get_embeddings
+
+tf.enable_eager_execution()
+
+
+class ServerBusy(Exception):
+    pass
+
+
+class EmbeddingServer:
+    """
+        dynamic micro-batching around get_embeddings
+        concurrent requests wait in a bounded queue, the batcher takes up to max_batch of them
+        (or whatever arrived within max_wait_ms of the first one) and runs one forward pass per batch
+        in a worker thread, so the event loop keeps accepting requests during the forward pass
+    """
+
+    def __init__(self, model, image_size, max_batch=32, max_wait_ms=5, max_queue=1024, cache=None):
+        """
+        :param model: MyModel
+        :param image_size:
+        :param max_batch: max images per forward pass
+        :param max_wait_ms: max time the first request of a batch waits for more
+        :param max_queue: queued requests above this are rejected (backpressure)
+        :param cache: EmbeddingCache, None to always run the model
+        """
+        self.model = model
+        self.image_size = image_size
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.cache = cache
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_rejected = 0
+        self.latencies = collections.deque(maxlen=10000)
+
+    def _forward(self, images_raw):
+        """
+            runs in the worker thread
+        :return: list of embedding or exception, one per image
+        """
+        if self.cache is not None:
+            try:
+                return list(self.cache.get_embeddings(images_raw))
+            except Exception:
+                # fall back to one by one decode so a bad image only fails its own request
+                pass
+        results = [None] * len(images_raw)
+        images = []
+        valid = []
+        for i, image_raw in enumerate(images_raw):
+            try:
+                images.append(decode_image(image_raw, self.image_size))
+                valid.append(i)
+            except (tf.errors.InvalidArgumentError, ValueError) as e:
+                results[i] = ValueError('invalid image: {}'.format(e))
+        if len(images) > 0:
+            embs = get_embeddings(self.model, tf.stack(images)).numpy()
+            for i, emb in zip(valid, embs):
+                results[i] = emb
+        return results
+
+    async def _batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                # take what is already queued without waiting
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self.executor, self._forward, [b[0] for b in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            self.num_batches += 1
+            now = time.time()
+            for (_, future, start), result in zip(batch, results):
+                self.latencies.append(now - start)
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        return asyncio.ensure_future(self._batcher())
+
+    async def embed(self, image_raw):
+        """
+        :param image_raw: encoded image bytes
+        :return: l2 normalized embedding, numpy, shape=[D]
+        :raise ServerBusy: if the queue is full
+        """
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.queue.put_nowait((image_raw, future, time.time()))
+        except asyncio.QueueFull:
+            self.num_rejected += 1
+            raise ServerBusy('queue full')
+        self.num_requests += 1
+        return await future
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        stats = {'requests': self.num_requests, 'batches': self.num_batches, 'rejected': self.num_rejected,
+                 'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+                 'mean_batch_size': self.num_requests / self.num_batches if self.num_batches > 0 else 0.0}
+        if latencies.size > 0:
+            stats['latency_ms_p50'] = float(np.percentile(latencies, 50))
+            stats['latency_ms_p99'] = float(np.percentile(latencies, 99))
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+
+async def _read_request(reader):
+    """
+        minimal HTTP/1.1 request parser
+    :return: method, path, headers, body, or None if the connection is closed
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def _response(status, payload):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+    body = json.dumps(payload).encode('utf-8')
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        status, reasons[status], len(body))
+    return head.encode('latin-1') + body
+
+
+def make_handler(server):
+    """
+        POST /embed with the encoded image as body -> {"embedding": [...]}
+        GET /stats -> server stats
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if method == 'POST' and path == '/embed':
+                    try:
+                        emb = await server.embed(body)
+                        writer.write(_response(200, {'embedding': emb.tolist()}))
+                    except ServerBusy:
+                        writer.write(_response(503, {'error': 'queue full'}))
+                    except ValueError as e:
+                        writer.write(_response(400, {'error': str(e)}))
+                elif method == 'GET' and path == '/stats':
+                    writer.write(_response(200, server.stats()))
+                else:
+                    writer.write(_response(404, {'error': 'not found'}))
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def load_test(host, port, image_raw, concurrency, num_requests):
+    """
+        concurrency keep-alive connections send num_requests POST /embed in total
+    """
+    latencies = []
+    statuses = collections.Counter()
+    remaining = [num_requests]
+    request = 'POST /embed HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+        host, len(image_raw)).encode('latin-1') + image_raw
+
+    async def worker():
+        reader, writer = await asyncio.open_connection(host, port)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.time()
+            writer.write(request)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                if line.lower().startswith(b'content-length'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.time() - start)
+            statuses[status] += 1
+        writer.close()
+
+    start = time.time()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.time() - start
+    latencies = np.array(latencies) * 1000
+    print('requests: {}, concurrency: {}, {:.1f} req/s, latency p50 {:.2f} ms, p99 {:.2f} ms, status {}'.format(
+        len(latencies), concurrency, len(latencies) / elapsed, np.percentile(latencies, 50),
+        np.percentile(latencies, 99), dict(statuses)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Serve face embeddings.')
+    parser.add_argument('--config_path', type=str, help='path to config path', default='configs/config.yaml')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--load_test', type=str, default=None, help='image path, load test a running server')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--num_requests', type=int, default=10000)
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    loop = asyncio.get_event_loop()
+
+    if args.load_test:
+        with open(args.load_test, 'rb') as f:
+            image_raw = f.read()
+        loop.run_until_complete(load_test(args.host, args.port, image_raw, args.concurrency, args.num_requests))
+        return
+
+    with open(args.config_path) as cfg:
+        config = yaml.load(cfg, Loader=yaml.FullLoader)
+    compute_dtype = set_policy(config.get('precision', 'float32'))
+    model = MyModel(ResNet_v1_50, embedding_size=config['embedding_size'], compute_dtype=compute_dtype)
+    ckpt_dir = os.path.expanduser(config['ckpt_dir'])
+    ckpt_path = tf.train.latest_checkpoint(ckpt_dir)
+    ckpt = tf.train.Checkpoint(backbone=model.backbone)
+    ckpt.restore(ckpt_path).expect_partial()
+    print("Restored from {}".format(ckpt_path))
+    # build the model before serving
+    get_embeddings(model, tf.zeros((1, config['image_size'], config['image_size'], 3)))
+
+    cache = None
+    if config.get('embedding_cache_mb'):
+        cache = EmbeddingCache(model, config['image_size'], config['embedding_cache_mb'],
+                               config.get('embedding_cache_dir'), config.get('serve_max_batch', 32))
+    server = EmbeddingServer(model, config['image_size'], config.get('serve_max_batch', 32),
+                             config.get('serve_max_wait_ms', 5), config.get('serve_max_queue', 1024), cache)
+    server.start()
+    loop.run_until_complete(asyncio.start_server(make_handler(server), args.host, args.port))
+    print('Serving on http://{}:{}'.format(args.host, args.port))
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
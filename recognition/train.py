@@ -10,9 +10,13 @@ import time
 import tensorflow as tf
 import yaml
 
+from common.checkpoint import PreemptionFlag
+from common.precision import LossScale, set_policy
+from common.train_loop import GradientAccumulator, TrainLoop
+from common.train_metrics import TrainMetrics
 from recognition.backbones.resnet_v1 import ResNet_v1_50
 from recognition.data.generate_data import GenerateData
-from recognition.losses.loss import arcface_loss, triplet_loss, center_loss
+from recognition.losses.loss import arcface_loss, triplet_loss, center_loss, online_triplet_loss
 from recognition.models.models import MyModel
 from recognition.predict import get_embeddings
 from recognition.valid import Valid_Data
@@ -33,12 +37,20 @@ tf.enable_eager_execution()
 # logger = logging.getLogger("mylogger")
 
 class Trainer:
-    def __init__(self, config):
+    def __init__(self, config, benchmark=False):
+        """
+        :param benchmark: only build the model, optimizer and train data: no validation data, checkpoint restore,
+                          summary dirs or metrics thread, see benchmark.py
+        """
+        # mixed precision policy must be set before the model is built
+        self.precision = config.get('precision', 'float32')
+        compute_dtype = set_policy(self.precision)
+        self.loss_scale = LossScale() if self.precision == 'float16' else None
         self.gd = GenerateData(config)
 
         self.train_data, cat_num = self.gd.get_train_data()
-        valid_data = self.gd.get_val_data(config['valid_num'])
-        self.model = MyModel(ResNet_v1_50, embedding_size=config['embedding_size'], classes=cat_num)    # 初始化，调用__init__函数
+        self.model = MyModel(ResNet_v1_50, embedding_size=config['embedding_size'], classes=cat_num,
+                             compute_dtype=compute_dtype, sample_rate=config.get('sample_rate', 1.0))    # 初始化，调用__init__函数
         self.epoch_num = config['epoch_num']
         self.m1 = config['logits_margin1']
         self.m2 = config['logits_margin2']
@@ -48,7 +60,12 @@ class Trainer:
         self.thresh = config['thresh']
         self.below_fpr = config['below_fpr']
         self.learning_rate = config['learning_rate']
+        self.image_size = config['image_size']
+        self.partial_fc_lr = config.get('partial_fc_lr', 0.1)
         self.loss_type = config['loss_type']
+        self.triplet_mining = config.get('triplet_mining', 'offline')
+        if self.loss_type == 'triplet' and self.triplet_mining != 'offline' and config.get('sampler') != 'pk':
+            raise ValueError('Online triplet mining needs sampler: pk')
 
         # center loss init
         self.centers = None
@@ -77,23 +94,36 @@ class Trainer:
         else:
             raise ValueError('Invalid optimization algorithm')
 
-        ckpt_dir = os.path.expanduser(config['ckpt_dir'])
-
-        if self.centers is None:
-            self.ckpt = tf.train.Checkpoint(backbone=self.model.backbone, model=self.model, optimizer=self.optimizer)
-        else:
+        # the first call creates the model variables
+        self.model(tf.zeros((1, self.image_size, self.image_size, 3)), training=False)
+        unused = []
+        if self.model.dense is not None:
+            unused += self.model.dense.trainable_variables     # no loss uses the plain dense head
+        if self.model.norm_dense is not None and self.loss_type != 'logit':
+            unused += self.model.norm_dense.trainable_variables
+        # gradients of accum_steps micro batches are averaged into one optimizer step
+        self.accumulator = GradientAccumulator(self.optimizer, config.get('accum_steps', 1), self.loss_scale)
+        self.accumulator.build(self.model.trainable_variables, unused)
+
+        if not benchmark:
+            self._init_run(config)
+
+    def _init_run(self, config):
+        """
+            checkpoints (restored if there is one), validation, summaries and metrics of a training run
+        """
+        valid_data, valid_pairs = self.gd.get_val_pair_data(config['valid_num'], config.get('valid_pairs_path'))
+
+        ckpt_items = {'backbone': self.model.backbone, 'model': self.model, 'optimizer': self.optimizer}
+        if self.centers is not None:
             # save centers if use center loss
-            self.ckpt = tf.train.Checkpoint(backbone=self.model.backbone, model=self.model, optimizer=self.optimizer,
-                                            centers=self.centers)
-        self.ckpt_manager = tf.train.CheckpointManager(self.ckpt, ckpt_dir, max_to_keep=5, checkpoint_name='mymodel')
-
-        if self.ckpt_manager.latest_checkpoint:
-            self.ckpt.restore(self.ckpt_manager.latest_checkpoint)
-            print("Restored from {}".format(self.ckpt_manager.latest_checkpoint))
-        else:
-            print("Initializing from scratch.")
+            ckpt_items['centers'] = self.centers
+        self.loop = TrainLoop(ckpt_items, os.path.expanduser(config['ckpt_dir']), self.accumulator,
+                              config.get('ckpt_steps', 0), config.get('ckpt_staging_dir'),
+                              config.get('ckpt_save_iterator', True))
 
-        self.vd = Valid_Data(self.model, valid_data)
+        self.vd = Valid_Data(self.model, valid_data, valid_pairs, config.get('valid_hist_bins'),
+                             config.get('valid_shards', 1))
 
         summary_dir = os.path.expanduser(config['summary_dir'])
         current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -110,12 +140,25 @@ class Trainer:
         # self.valid_summary_writer = tf.summary.create_file_writer(valid_log_dir)
         self.train_summary_writer = tf.compat.v2.summary.create_file_writer(train_log_dir)
         self.valid_summary_writer = tf.compat.v2.summary.create_file_writer(valid_log_dir)
+        if self.loss_type == 'triplet' and self.triplet_mining != 'offline':
+            metric_names = ['loss', 'num_triplets']
+        elif self.loss_type == 'triplet':
+            metric_names = ['loss']
+        else:
+            metric_names = ['loss', 'logit_loss', 'center_loss']
+        self.metrics = TrainMetrics(metric_names, self.train_summary_writer, config.get('metrics_flush_steps', 100))
 
         # self.graph_writer = tf.compat.v2.summary.create_file_writer(self.graph_log_dir)
         # tf.compat.v2.summary.trace_on(graph=True, profiler=True)
         # with graph_writer.as_default():
         #     tf.compat.v2.summary.trace_export(name="graph_trace", step=0, profiler_outdir=graph_log_dir)
 
+    def _apply_gradients(self, tape, loss):
+        # with float16 the loss is scaled up so small gradients survive, apply_gradients scales them back
+        output_gradients = self.loss_scale.scale if self.loss_scale is not None else None
+        gradients = tape.gradient(loss, self.model.trainable_variables, output_gradients=output_gradients)
+        self.accumulator.add(gradients)
+
     @tf.function    # 将动态图转为静态图以加快程序运行速度，调试时可注释该局并打印中间变量
     def _train_step(self, img, label):
         with tf.GradientTape(persistent=False) as tape:
@@ -132,8 +175,38 @@ class Trainer:
                 ct_loss = 0
 
             loss = logit_loss + self.ct_loss_factor * ct_loss
-        gradients = tape.gradient(loss, self.model.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        self._apply_gradients(tape, loss)
+
+        return loss, logit_loss, ct_loss
+
+    @tf.function
+    def _train_partial_fc_step(self, img, label):
+        partial_fc = self.model.partial_fc
+        index, sampled_label = partial_fc.sample(label)
+        sub_w = tf.gather(partial_fc.w, index)
+        with tf.GradientTape(persistent=False) as tape:
+            tape.watch(sub_w)
+            prelogits, _, _ = self.model(img, training=True)
+            norm_dense = partial_fc(prelogits, sub_w=sub_w)
+            logit_loss = arcface_loss(prelogits, norm_dense, sampled_label, self.m1, self.m2, self.m3, self.s)
+
+            if self.centers is not None:
+                ct_loss, self.centers = center_loss(prelogits, label, self.centers, self.ct_alpha)
+            else:
+                ct_loss = 0
+
+            loss = logit_loss + self.ct_loss_factor * ct_loss
+        variables = self.model.trainable_variables
+        output_gradients = self.loss_scale.scale if self.loss_scale is not None else None
+        gradients = tape.gradient(loss, variables + [sub_w], output_gradients=output_gradients)
+        sub_w_grad = gradients[-1]
+        if self.loss_scale is not None:
+            sub_w_grad = sub_w_grad / self.loss_scale.scale
+            sub_w_grad = tf.where(tf.math.is_finite(sub_w_grad), sub_w_grad, tf.zeros_like(sub_w_grad))
+        # only the sampled rows are updated, no optimizer slots for the centers
+        # the sampled rows change every micro batch, so they are updated right away, scaled like the accumulation
+        partial_fc.update(index, sub_w_grad / self.accumulator.accum_steps, self.partial_fc_lr)
+        self.accumulator.add(gradients[:-1])
 
         return loss, logit_loss, ct_loss
 
@@ -146,60 +219,75 @@ class Trainer:
 
             loss = triplet_loss(anchor_emb, pos_emb, neg_emb, self.alpha)
 
-        gradients = tape.gradient(loss, self.model.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        self._apply_gradients(tape, loss)
 
         return loss
 
+    @tf.function
+    def _train_online_triplet_step(self, img, label):
+        with tf.GradientTape(persistent=False) as tape:
+            embs = get_embeddings(self.model, img)
+            loss, num_triplets = online_triplet_loss(embs, label, self.alpha, self.triplet_mining)
+
+        self._apply_gradients(tape, loss)
+
+        return loss, num_triplets
+
+    def epoch_data(self):
+        """
+            offline triplets are mined again for every epoch
+        :return: dataset of this epoch (None if there is nothing to train on), step_fn(*batch) -> tuple of
+                 the metrics, whether the saved iterator state belongs to the dataset
+        """
+        if self.loss_type == 'triplet' and self.triplet_mining != 'offline':
+            # mine triplets inside each P x K batch
+            return self.train_data, self._train_online_triplet_step, True
+        elif self.loss_type == 'triplet':
+            train_data, num_triplets = self.gd.get_train_triplets_data(self.model)
+            print('triplets num is {}'.format(num_triplets))
+            # triplets are mined again, a saved iterator state belongs to the old ones
+            return (train_data if num_triplets > 0 else None,
+                    lambda anchor, pos, neg: (self._train_triplet_step(anchor, pos, neg),), False)
+        elif self.loss_type == 'logit':
+            # logit loss
+            train_step = self._train_step if self.model.partial_fc is None else self._train_partial_fc_step
+            return self.train_data, train_step, True
+        else:
+            raise ValueError('Invalid loss type')
+
     def train(self):
-        for epoch in range(self.epoch_num):
-            start = time.time()
-            # triplet loss
-            if self.loss_type == 'triplet':
-                train_data, num_triplets = self.gd.get_train_triplets_data(self.model)
-                print('triplets num is {}'.format(num_triplets))
-                if num_triplets > 0:
-                    for step, (anchor, pos, neg) in enumerate(train_data):
-                        loss = self._train_triplet_step(anchor, pos, neg)
-                        with self.train_summary_writer.as_default():
-                            tf.compat.v2.summary.scalar('loss', loss, step=step)
-                        print('epoch: {}, step: {}, loss = {}'.format(epoch, step, loss))
-            elif self.loss_type == 'logit':
-                # logit loss
-                for step, (input_image, target) in enumerate(self.train_data):
-                    loss, logit_loss, ct_loss = self._train_step(input_image, target)
-                    with self.train_summary_writer.as_default():
-                        tf.compat.v2.summary.scalar('loss', loss, step=step)
-                        tf.compat.v2.summary.scalar('logit_loss', logit_loss, step=step)
-                        tf.compat.v2.summary.scalar('center_loss', ct_loss, step=step)
-                    print('epoch: {}, step: {}, loss = {}, logit_loss = {}, center_loss = {}'.format(epoch, step, loss,
-                                                                                                     logit_loss,
-                                                                                                     ct_loss))
-            else:
-                raise ValueError('Invalid loss type')
-
-            # valid
-            acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr = self.vd.get_metric(self.thresh, self.below_fpr)
-
-            with self.valid_summary_writer.as_default():
-                tf.compat.v2.summary.scalar('acc', acc, step=epoch)
-                tf.compat.v2.summary.scalar('p', p, step=epoch)
-                tf.compat.v2.summary.scalar('r=tpr', r, step=epoch)
-                tf.compat.v2.summary.scalar('fpr', fpr, step=epoch)
-                tf.compat.v2.summary.scalar('acc_fpr', acc_fpr, step=epoch)
-                tf.compat.v2.summary.scalar('p_fpr', p_fpr, step=epoch)
-                tf.compat.v2.summary.scalar('r=tpr_fpr', r_fpr, step=epoch)
-                tf.compat.v2.summary.scalar('thresh_fpr', thresh_fpr, step=epoch)
-            print('epoch: {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, fpr: {:.3f} \n'
-                  'fix fpr <= {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, thresh: {:.3f}'
-                  .format(epoch, acc, p, r, fpr, self.below_fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr))
-
-            # ckpt
-            # if epoch % 5 == 0:
-            save_path = self.ckpt_manager.save()
-            print('Saving checkpoint for epoch {} at {}'.format(epoch, save_path))
-
-            print('Time taken for epoch {} is {} sec\n'.format(epoch, time.time() - start))
+        with PreemptionFlag() as preemption:
+            for epoch in self.loop.epochs(self.epoch_num):
+                start = time.time()
+                train_data, train_step, restore = self.epoch_data()
+                if self.loop.run_epoch(epoch, train_data, train_step, self.metrics, preemption, restore):
+                    break
+
+                # valid
+                acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr = self.vd.get_metric(self.thresh, self.below_fpr)
+
+                with self.valid_summary_writer.as_default():
+                    tf.compat.v2.summary.scalar('acc', acc, step=epoch)
+                    tf.compat.v2.summary.scalar('p', p, step=epoch)
+                    tf.compat.v2.summary.scalar('r=tpr', r, step=epoch)
+                    tf.compat.v2.summary.scalar('fpr', fpr, step=epoch)
+                    tf.compat.v2.summary.scalar('acc_fpr', acc_fpr, step=epoch)
+                    tf.compat.v2.summary.scalar('p_fpr', p_fpr, step=epoch)
+                    tf.compat.v2.summary.scalar('r=tpr_fpr', r_fpr, step=epoch)
+                    tf.compat.v2.summary.scalar('thresh_fpr', thresh_fpr, step=epoch)
+                    tf.compat.v2.summary.scalar('auc', self.vd.roc.auc(), step=epoch)
+                print('epoch: {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, fpr: {:.3f} \n'
+                      'fix fpr <= {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, thresh: {:.3f}'
+                      .format(epoch, acc, p, r, fpr, self.below_fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr))
+
+                # ckpt, at the start of the next epoch
+                # if epoch % 5 == 0:
+                save_path = self.loop.end_epoch(epoch)
+                print('Saving checkpoint for epoch {} at {}'.format(epoch, save_path))
+
+                print('Time taken for epoch {} is {} sec\n'.format(epoch, time.time() - start))
+        self.metrics.close(self.loop.step)
+        self.loop.close()
 
 
 def parse_args(argv):
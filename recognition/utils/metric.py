@@ -0,0 +1,86 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+
+
+class Roc:
+    """
+        exact ROC of verification scores, scores are sorted once and tp/fp are cumulative sums,
+        point i predicts positive for sim >= thresholds[i], thresholds are descending
+    """
+
+    def __init__(self, sims, labels):
+        sims = np.asarray(sims, dtype=np.float64).ravel()
+        labels = np.asarray(labels, dtype=np.bool_).ravel()
+        assert (sims.shape == labels.shape)
+        order = np.argsort(-sims, kind='mergesort')
+        sims = sims[order]
+        labels = labels[order]
+        # last index of every run of equal scores
+        last = np.concatenate((np.where(np.diff(sims) != 0)[0], [len(sims) - 1]))
+        tp = np.cumsum(labels)[last]
+        fp = np.cumsum(~labels)[last]
+
+        # point 0 predicts nothing positive
+        first = np.nextafter(sims[0], np.inf) if len(sims) > 0 else 1.0
+        self._set_curve(np.concatenate(([first], sims[last])), np.concatenate(([0], tp)),
+                        np.concatenate(([0], fp)), int(np.sum(labels)), int(np.sum(~labels)))
+
+    @classmethod
+    def from_histogram(cls, edges, pos_counts, neg_counts):
+        """
+            roc from score histograms, thresholds are quantized to the bin edges
+        :param edges: bin edges, shape=[bins + 1], ascending
+        :param pos_counts: positive pair count of each bin, shape=[bins]
+        :param neg_counts: negative pair count of each bin, shape=[bins]
+        """
+        roc = cls.__new__(cls)
+        # bin i predicts positive for every bin >= i, threshold is its lower edge
+        tp = np.cumsum(np.asarray(pos_counts)[::-1])
+        fp = np.cumsum(np.asarray(neg_counts)[::-1])
+        roc._set_curve(np.concatenate(([edges[-1]], edges[-2::-1])), np.concatenate(([0], tp)),
+                       np.concatenate(([0], fp)), int(tp[-1]), int(fp[-1]))
+        return roc
+
+    def _set_curve(self, thresholds, tp, fp, num_pos, num_neg):
+        self.num_pos = num_pos
+        self.num_neg = num_neg
+        self.num = num_pos + num_neg
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.tp = np.asarray(tp, dtype=np.float64)
+        self.fp = np.asarray(fp, dtype=np.float64)
+        tn = self.num_neg - self.fp
+        self.tpr = self.tp / max(self.num_pos, 1)
+        self.fpr = self.fp / max(self.num_neg, 1)
+        self.acc = (self.tp + tn) / max(self.num, 1)
+        pred_pos = self.tp + self.fp
+        self.precision = np.where(pred_pos > 0, self.tp / np.maximum(pred_pos, 1), 0)
+
+    def _point(self, i):
+        return self.acc[i], self.precision[i], self.tpr[i], self.fpr[i]
+
+    def metric_at(self, thresh):
+        """
+        :return: acc, p, r=tpr, fpr of sim >= thresh
+        """
+        i = np.searchsorted(-self.thresholds, -thresh, side='right') - 1
+        return self._point(max(i, 0))
+
+    def tar_at_far(self, far):
+        """
+            the point with the highest tar whose fpr <= far
+        :return: acc, p, r=tpr, thresh
+        """
+        i = np.searchsorted(self.fpr, far, side='right') - 1
+        acc, p, r, _ = self._point(i)
+        return acc, p, r, self.thresholds[i]
+
+    def best_acc(self):
+        """
+        :return: best acc, thresh
+        """
+        i = int(np.argmax(self.acc))
+        return self.acc[i], self.thresholds[i]
+
+    def auc(self):
+        return float(np.sum(np.diff(self.fpr) * (self.tpr[1:] + self.tpr[:-1]) / 2))
@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+from recognition.utils.metric import Roc
+
+
+class ScoreHistogram:
+    """
+        fixed-size histograms of positive and negative pair scores,
+        memory does not grow with the pair number and histograms of shards can be merged
+    """
+
+    def __init__(self, bins=65536, low=-1.0, high=1.0):
+        self.bins = bins
+        self.low = low
+        self.high = high
+        self.pos = np.zeros(bins, dtype=np.int64)
+        self.neg = np.zeros(bins, dtype=np.int64)
+
+    def update(self, sims, labels):
+        sims = np.asarray(sims, dtype=np.float64).ravel()
+        labels = np.asarray(labels, dtype=np.bool_).ravel()
+        idx = ((sims - self.low) / (self.high - self.low) * self.bins).astype(np.int64)
+        idx = np.clip(idx, 0, self.bins - 1)
+        self.pos += np.bincount(idx[labels], minlength=self.bins)
+        self.neg += np.bincount(idx[~labels], minlength=self.bins)
+        return self
+
+    def merge(self, other):
+        assert (self.bins == other.bins and self.low == other.low and self.high == other.high)
+        self.pos += other.pos
+        self.neg += other.neg
+        return self
+
+    def save(self, path):
+        with open(os.path.expanduser(path), 'wb') as f:
+            np.savez(f, pos=self.pos, neg=self.neg, range=np.array([self.low, self.high]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(os.path.expanduser(path)) as data:
+            hist = cls(len(data['pos']), float(data['range'][0]), float(data['range'][1]))
+            hist.pos += data['pos']
+            hist.neg += data['neg']
+        return hist
+
+    def to_roc(self):
+        edges = np.linspace(self.low, self.high, self.bins + 1)
+        return Roc.from_histogram(edges, self.pos, self.neg)
+
+
+def score_pairs(embs, idx1, idx2, labels, hist, chunk_size=1 << 20):
+    """
+        score pairs chunk by chunk into hist, only one chunk of scores is in memory
+    :param embs: l2 normalized embeddings, can be a memmap
+    """
+    for begin in range(0, len(labels), chunk_size):
+        end = begin + chunk_size
+        sims = np.sum(embs[idx1[begin:end]] * embs[idx2[begin:end]], axis=-1)
+        hist.update(sims, labels[begin:end])
+    return hist
+
+
+def _score_shard(args):
+    emb_path, idx1, idx2, labels, bins, chunk_size = args
+    embs = np.load(emb_path, mmap_mode='r')
+    hist = score_pairs(embs, idx1, idx2, labels, ScoreHistogram(bins), chunk_size)
+    return hist.pos, hist.neg
+
+
+def score_pairs_sharded(embs, idx1, idx2, labels, bins=65536, num_shards=4, chunk_size=1 << 20):
+    """
+        split the pairs into num_shards processes, each scores its shard against a memory-mapped
+        copy of embs, the shard histograms are merged at the end
+    :return: ScoreHistogram
+    """
+    hist = ScoreHistogram(bins)
+    shards = np.array_split(np.arange(len(labels)), num_shards)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        emb_path = os.path.join(tmp_dir, 'embs.npy')
+        np.save(emb_path, np.asarray(embs, dtype=np.float32))
+        args = [(emb_path, idx1[s], idx2[s], labels[s], bins, chunk_size) for s in shards if len(s) > 0]
+        with multiprocessing.get_context('spawn').Pool(num_shards) as pool:
+            for pos, neg in pool.map(_score_shard, args):
+                hist.pos += pos
+                hist.neg += neg
+    return hist
@@ -9,105 +9,117 @@ import tensorflow as tf
 import yaml
 
 from recognition.backbones.resnet_v1 import ResNet_v1_50
+from recognition.data.bin_data import BinData
 from recognition.data.generate_data import GenerateData
 from recognition.models.models import MyModel
 from recognition.predict import get_embeddings
+from recognition.utils.metric import Roc
+from recognition.utils.stream_eval import ScoreHistogram, score_pairs, score_pairs_sharded
 
 tf.enable_eager_execution()
 
 
 class Valid_Data:
-    def __init__(self, model, data):
+    def __init__(self, model, data, pairs=None, bins=None, num_shards=1):
+        """
+        :param model:
+        :param data: dataset of (image1, image2, label) batches,
+                     or dataset of image batches in pairs.paths order if pairs is given
+        :param pairs: PairSet
+        :param bins: if set, accumulate scores into histograms of this many bins instead of keeping them all
+        :param num_shards: processes scoring the pairs in histogram mode
+        """
         self.model = model
         self.data = data
+        self.pairs = pairs
+        self.bins = bins
+        self.num_shards = num_shards
+        self.roc = None
 
     @staticmethod
     def _cal_cos_sim(emb1, emb2):
         return tf.reduce_sum(emb1 * emb2, axis=-1)
 
+    def _get_embeddings(self):
+        embs = np.zeros((len(self.pairs.paths), self.model.backbone.dense.units), dtype=np.float32)
+        begin = 0
+        for image in self.data:
+            emb = get_embeddings(self.model, image).numpy()
+            embs[begin:begin + emb.shape[0]] = emb
+            begin += emb.shape[0]
+        return embs
+
     def _get_sim_label(self):
-        sims = None
-        labels = None
+        if self.pairs is not None:
+            embs = self._get_embeddings()
+            return self.pairs.cal_sims(embs), self.pairs.labels
+
+        sims = []
+        labels = []
         for image1, image2, label in self.data:
             emb1 = get_embeddings(self.model, image1)
             emb2 = get_embeddings(self.model, image2)
-            sim = self._cal_cos_sim(emb1, emb2)
-            if sims is None:
-                sims = sim
-            else:
-                sims = tf.concat([sims, sim], axis=0)
+            sims.append(self._cal_cos_sim(emb1, emb2).numpy())
+            labels.append(label.numpy())
+
+        return np.concatenate(sims), np.concatenate(labels)
 
-            if labels is None:
-                labels = label
-            else:
-                labels = tf.concat([labels, label], axis=0)
+    def _get_histogram(self):
+        if self.pairs is not None:
+            embs = self._get_embeddings()
+            if self.num_shards > 1:
+                return score_pairs_sharded(embs, self.pairs.idx1, self.pairs.idx2, self.pairs.labels, self.bins,
+                                           self.num_shards)
+            return score_pairs(embs, self.pairs.idx1, self.pairs.idx2, self.pairs.labels, ScoreHistogram(self.bins))
 
-        return sims, labels
+        hist = ScoreHistogram(self.bins)
+        for image1, image2, label in self.data:
+            emb1 = get_embeddings(self.model, image1)
+            emb2 = get_embeddings(self.model, image2)
+            hist.update(self._cal_cos_sim(emb1, emb2).numpy(), label.numpy())
+        return hist
 
     @staticmethod
     def _cal_metric(sim, label, thresh):
-        tp = tn = fp = fn = 0
-        predict = tf.greater_equal(sim, thresh)
-        for i in range(len(predict)):
-            if predict[i] and label[i]:
-                tp += 1
-            elif predict[i] and not label[i]:
-                fp += 1
-            elif not predict[i] and label[i]:
-                fn += 1
-            else:
-                tn += 1
-        acc = (tp + tn) / len(predict)
-        p = 0 if tp + fp == 0 else tp / (tp + fp)
-        r = 0 if tp + fn == 0 else tp / (tp + fn)
-        fpr = 0 if fp + tn == 0 else fp / (fp + tn)
-        return acc, p, r, fpr
-
-    def _cal_metric_fpr(self, sim, label, below_fpr=0.001):
-        acc = p = r = thresh = 0
-        for t in np.linspace(-1, 1, 100):
-            thresh = t
-            acc, p, r, fpr = self._cal_metric(sim, label, thresh)
-            if fpr <= below_fpr:
-                break
-
-        return acc, p, r, thresh
+        return Roc(sim, label).metric_at(thresh)
+
+    def get_roc(self):
+        if self.bins:
+            self.roc = self._get_histogram().to_roc()
+        else:
+            sim, label = self._get_sim_label()
+            self.roc = Roc(sim, label)
+        return self.roc
 
     def get_metric(self, thresh=0.2, below_fpr=0.001):
-        sim, label = self._get_sim_label()
-        acc, p, r, fpr = self._cal_metric(sim, label, thresh)
-        acc_fpr, p_fpr, r_fpr, thresh_fpr = self._cal_metric_fpr(sim, label, below_fpr)
+        roc = self.get_roc()
+        acc, p, r, fpr = roc.metric_at(thresh)
+        acc_fpr, p_fpr, r_fpr, thresh_fpr = roc.tar_at_far(below_fpr)
         return acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr
 
-    def draw_curve(self):
-        P = []
-        R = []
-        TPR = []
-        FPR = []
-        sim, label = self._get_sim_label()
-        for thresh in np.linspace(-1, 1, 100):
-            acc, p, r, fpr = self._cal_metric(sim, label, thresh)
-            P.append(p)
-            R.append(r)
-            TPR.append(r)
-            FPR.append(fpr)
+    def draw_curve(self, roc=None):
+        # reuse the roc of the last get_metric, embeddings are not computed again
+        if roc is None:
+            roc = self.roc if self.roc is not None else self.get_roc()
 
         plt.axis([0, 1, 0, 1])
         plt.xlabel("R")
         plt.ylabel("P")
-        plt.plot(R, P, color="r", linestyle="--", marker="*", linewidth=1.0)
+        plt.plot(roc.tpr[1:], roc.precision[1:], color="r", linestyle="--", linewidth=1.0)
         plt.show()
 
         plt.axis([0, 1, 0, 1])
         plt.xlabel("FRP")
         plt.ylabel("TPR")
-        plt.plot(FPR, TPR, color="r", linestyle="--", marker="*", linewidth=1.0)
+        plt.plot(roc.fpr, roc.tpr, color="r", linestyle="--", linewidth=1.0)
         plt.show()
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description='valid model')
     parser.add_argument('--config_path', type=str, help='path to config path', default='configs/config.yaml')
+    parser.add_argument('--bin_path', type=str, nargs='*', help='packed verification sets, e.g. lfw.bin',
+                        default=None)
 
     args = parser.parse_args(argv)
 
@@ -120,8 +132,6 @@ def main():
 
     with open(args.config_path) as cfg:
         config = yaml.load(cfg, Loader=yaml.FullLoader)
-    gd = GenerateData(config)
-    valid_data = gd.get_val_data(config['valid_num'])
     model = MyModel(ResNet_v1_50, embedding_size=config['embedding_size'])
     import os
     ckpt_dir = os.path.expanduser(config['ckpt_dir'])
@@ -129,9 +139,24 @@ def main():
     ckpt.restore(tf.train.latest_checkpoint(ckpt_dir)).expect_partial()
     print("Restored from {}".format(tf.train.latest_checkpoint(ckpt_dir)))
 
-    vd = Valid_Data(model, valid_data)
+    if args.bin_path:
+        for bin_path in args.bin_path:
+            bd = BinData(bin_path, config['image_size'], config.get('bin_cache_dir')).load()
+            vd = Valid_Data(model, bd.get_data(config['valid_batch_size']), bd.pairs, config.get('valid_hist_bins'),
+                            config.get('valid_shards', 1))
+            acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr = vd.get_metric(config['thresh'], config['below_fpr'])
+            best_acc, best_thresh = vd.roc.best_acc()
+            print('{}: acc: {:.4f}, tar: {:.4f} at far <= {}, best acc: {:.4f} at thresh {:.4f}, auc: {:.4f}'
+                  .format(bd.name, acc, r_fpr, config['below_fpr'], best_acc, best_thresh, vd.roc.auc()))
+        return
+
+    gd = GenerateData(config)
+    valid_data, valid_pairs = gd.get_val_pair_data(config['valid_num'], config.get('valid_pairs_path'))
+    vd = Valid_Data(model, valid_data, valid_pairs, config.get('valid_hist_bins'), config.get('valid_shards', 1))
     acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr = vd.get_metric(0.2, 0.001)
     print(acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr)
+    best_acc, best_thresh = vd.roc.best_acc()
+    print('auc: {:.4f}, best acc: {:.4f} at thresh {:.4f}'.format(vd.roc.auc(), best_acc, best_thresh))
     vd.draw_curve()
 
 
@@ -2,6 +2,8 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import tensorflow as tf
 
+from common.fuse import check_not_traced, fuse_conv_bn, record_trace
+
 tf.enable_eager_execution()
 
 
@@ -16,18 +18,29 @@ class BasicBlock(tf.keras.layers.Layer):
         self.bn2 = tf.keras.layers.BatchNormalization()
         self.conv3 = tf.keras.layers.Conv2D(filters, (1, 1), padding='same', strides=strides)
         self.bn3 = tf.keras.layers.BatchNormalization()
+        self.fused = False
+
+    def fuse(self):
+        if not self.fused:
+            for conv, bn in ((self.conv1, self.bn1), (self.conv2, self.bn2), (self.conv3, self.bn3)):
+                if conv.built:  # conv3 is only built if the shortcut needs a projection
+                    fuse_conv_bn(conv, bn)
+            self.fused = True
 
     def call(self, inputs, training=False):
         x = self.conv1(inputs)
-        x = self.bn1(x, training=training)
+        if not self.fused:
+            x = self.bn1(x, training=training)
         x = self.relu(x)
         x = self.conv2(x)
-        x = self.bn2(x, training=training)
+        if not self.fused:
+            x = self.bn2(x, training=training)
         if x.shape == inputs.shape:
             res = inputs
         else:
             res = self.conv3(inputs)
-            res = self.bn3(res, training=training)
+            if not self.fused:
+                res = self.bn3(res, training=training)
         x += res
         x = self.relu(x)
         return x
@@ -46,21 +59,34 @@ class Bottleneck(tf.keras.layers.Layer):
         self.bn3 = tf.keras.layers.BatchNormalization()
         self.conv4 = tf.keras.layers.Conv2D(filters * 4, (1, 1), padding='same', strides=strides)
         self.bn4 = tf.keras.layers.BatchNormalization()
+        self.fused = False
+
+    def fuse(self):
+        if not self.fused:
+            for conv, bn in ((self.conv1, self.bn1), (self.conv2, self.bn2), (self.conv3, self.bn3),
+                             (self.conv4, self.bn4)):
+                if conv.built:
+                    fuse_conv_bn(conv, bn)
+            self.fused = True
 
     def call(self, inputs, training=False):
         x = self.conv1(inputs)
-        x = self.bn1(x, training=training)
+        if not self.fused:
+            x = self.bn1(x, training=training)
         x = self.relu(x)
         x = self.conv2(x)
-        x = self.bn2(x, training=training)
+        if not self.fused:
+            x = self.bn2(x, training=training)
         x = self.relu(x)
         x = self.conv3(x)
-        x = self.bn3(x, training=training)
+        if not self.fused:
+            x = self.bn3(x, training=training)
         if x.shape == inputs.shape:
             res = inputs
         else:
             res = self.conv4(inputs)
-            res = self.bn4(res, training=training)
+            if not self.fused:
+                res = self.bn4(res, training=training)
         x += res
         x = self.relu(x)
         return x
@@ -84,10 +110,29 @@ class ResNet_v1(tf.keras.Model):
         # self.dense = None
         # if include_top:
         #     self.dense = tf.keras.layers.Dense(embedding_size)
+        self.fused = False
+        self.traced = False
+
+    def fuse(self):
+        """
+            fold every BatchNormalization into the conv before it, for inference only:
+            the conv weights are overwritten, so neither train nor save the fused model into a training checkpoint.
+            fuse a model built by an eager call before it gets traced, a traced model raises a RuntimeError
+        """
+        check_not_traced(self)
+        if not self.fused:
+            fuse_conv_bn(self.conv, self.bn)
+            for blocks in (self.blocks1, self.blocks2, self.blocks3, self.blocks4):
+                for block in blocks.layers:
+                    block.fuse()
+            self.fused = True
+        return self
 
     def call(self, inputs, training=False, mask=None):
+        record_trace(self)
         x = self.conv(inputs)
-        x = self.bn(x, training=training)
+        if not self.fused:
+            x = self.bn(x, training=training)
         x = self.relu(x)
         x = self.maxpool(x)
         c2 = self.blocks1(x, training=training)
@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import tensorflow as tf
 
+from common.fuse import check_fuse
 from retinaface.backbones.resnet_v1 import ResNet_v1_18, ResNet_v1_34, ResNet_v1_50, ResNet_v1_101, ResNet_v1_152
 
 tf.enable_eager_execution()
@@ -23,6 +24,14 @@ class FPN(tf.keras.Model):
         self.anti_aliasing2 = tf.keras.layers.Conv2D(256, (3, 3), padding='same')
         self.top_down = tf.keras.layers.UpSampling2D(size=(2, 2))
 
+    def fuse(self):
+        """
+            fold the batch norms of the resnet into its convs for inference, the fpn convs have no batch norm,
+            see ResNet_v1.fuse
+        """
+        self.backbone.fuse()
+        return self
+
     def call(self, inputs, training=False, mask=None):
         c2, c3, c4, c5 = self.backbone(inputs, training=training)
         p6 = self.bottom_up(c5)
@@ -74,6 +83,7 @@ def parse_args(argv):
     import argparse
     parser = argparse.ArgumentParser(description='Resnet v1 model.')
     parser.add_argument('--config_path', type=str, help='path to config path', default='../configs/config.yaml')
+    parser.add_argument('--check_fuse', action='store_true', help='check the bn fused model against the original')
 
     args = parser.parse_args(argv)
 
@@ -84,6 +94,9 @@ def main():
     import sys
     args = parse_args(sys.argv[1:])
     # logger.info(args)
+    if args.check_fuse:
+        check_fuse(ResNet_v1_50_FPN, (1, 640, 640, 3))
+        return
     from retinaface.data.generate_data import GenerateData
     import yaml
     with open(args.config_path) as cfg:
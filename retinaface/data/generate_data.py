@@ -5,6 +5,8 @@ import os
 import cv2
 import tensorflow as tf
 
+from retinaface.data.synthetic import SyntheticData
+
 tf.enable_eager_execution()
 
 
@@ -12,8 +14,20 @@ class GenerateData:
 
     def __init__(self, config=None):
         self.config = config
-        self._train_paths, self._train_labels = self._get_path_label(self.config['train_dir'],
-                                                                     self.config['image_size'])
+        self.data_format = self.config.get('data_format', 'folder')  # folder or synthetic
+        if self.data_format == 'folder':
+            self.synthetic = None
+            self._train_paths, self._train_labels = self._get_path_label(self.config['train_dir'],
+                                                                         self.config['image_size'])
+        elif self.data_format == 'synthetic':
+            # random images and faces in memory, no dataset needed (benchmarks)
+            self.synthetic = SyntheticData(self.config.get('synthetic_images', 1000), self.config['image_size'],
+                                           self.config.get('synthetic_faces', 3),
+                                           max_faces=self.config.get('synthetic_max_faces', 50),
+                                           pool_size=self.config.get('synthetic_pool', 32))
+            self._train_paths, self._train_labels = self.synthetic.paths, self.synthetic.labels
+        else:
+            raise ValueError('Invalid data format')
         # self._valid_paths, self._valid_labels = self._get_path_label(self.config['valid_dir'],
         #                                                              self.config['image_size'])
 
@@ -84,6 +98,9 @@ class GenerateData:
         return image, label, image_path
 
     def get_train_data(self):
+        if self.synthetic is not None:
+            return self.synthetic.get_train_data(self.config['batch_size'])
+
         paths, labels = self._train_paths, self._train_labels
         assert (len(paths) == len(labels))
         total = len(paths)
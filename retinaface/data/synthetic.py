@@ -0,0 +1,76 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+tf.enable_eager_execution()
+
+# 5 landmarks (eyes, nose, mouth corners) relative to the face box, from the arcface 112x112 alignment template
+LANDMARK_TEMPLATE = np.array([[38.29, 51.70], [73.53, 51.50], [56.03, 71.74], [41.55, 92.37], [70.73, 92.20]],
+                             dtype=np.float32) / 112
+
+
+class SyntheticData:
+    """
+        random train data without any file io, to benchmark the model and the input pipeline
+        1. faces per image follow a long tail (lognormal, like wider face: mostly a few faces, some crowds),
+           clipped to [1, max_faces]
+        2. face sizes are log-uniform in [min_face, max_face * image_size], so small faces dominate
+        3. labels are in the GenerateData format, 14 floats per face: box x1, y1, x2, y2, then 5 landmarks x, y
+        4. images are gathered from a fixed pool of random uint8 images kept in memory,
+           image i uses pool[i % pool_size]
+    """
+
+    def __init__(self, num_images, image_size, mean_faces=3, max_faces=50, min_face=8, max_face=0.5, pool_size=32,
+                 sigma=1.0, seed=0):
+        """
+        :param num_images: train image number
+        :param image_size:
+        :param mean_faces: mean face number per image before clipping
+        :param max_faces:
+        :param min_face: smallest face side in pixels
+        :param max_face: largest face side, fraction of image_size
+        :param pool_size: random images kept in memory
+        :param sigma: lognormal sigma, larger for a longer tail
+        :param seed:
+        """
+        rng = np.random.RandomState(seed)
+        counts = rng.lognormal(np.log(mean_faces) - sigma ** 2 / 2, sigma, size=num_images)
+        self.counts = np.clip(np.round(counts), 1, max_faces).astype(np.int64)
+        self.image_size = image_size
+        self.pool_size = pool_size
+        self.paths = ['synthetic/{:06d}.jpg'.format(i) for i in range(num_images)]
+        self.labels = [self._random_faces(rng, count, min_face, max_face * image_size) for count in self.counts]
+        self.pool = rng.randint(0, 256, size=(pool_size, image_size, image_size, 3)).astype(np.uint8)
+
+    def _random_faces(self, rng, count, min_face, max_face):
+        max_face = max(max_face, min_face)
+        sizes = np.exp(rng.uniform(np.log(min_face), np.log(max_face), size=count))
+        widths = sizes * rng.uniform(0.75, 1.0, size=count)
+        x1 = rng.uniform(0, self.image_size - widths)
+        y1 = rng.uniform(0, self.image_size - sizes)
+        boxes = np.stack((x1, y1, x1 + widths, y1 + sizes), axis=1)
+        jitter = rng.normal(0, 0.02, size=(count, 5, 2))
+        landmarks = (LANDMARK_TEMPLATE[None, ...] + jitter) * np.stack((widths, sizes), axis=1)[:, None, :]
+        landmarks += boxes[:, None, :2]
+        return np.concatenate((boxes, landmarks.reshape(count, 10)), axis=1).tolist()
+
+    def get_train_data(self, batch_size):
+        """
+        :return: dataset of (image, label, image_path) batches, same as GenerateData.get_train_data
+        """
+        pool = tf.constant(self.pool)
+        total = len(self.paths)
+
+        def gather_image(idx, image_path, label):
+            image = tf.gather(pool, tf.math.floormod(idx, self.pool_size))
+            return tf.cast(image, tf.float32) / 255, label, image_path
+
+        train_dataset = tf.data.Dataset.from_tensor_slices((tf.range(total), self.paths,
+                                                            tf.ragged.constant(self.labels)))
+        train_dataset = train_dataset.shuffle(total)
+        train_dataset = train_dataset.map(gather_image, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        train_dataset = train_dataset.batch(batch_size)
+        train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+        return train_dataset
@@ -27,22 +27,38 @@ class ContextModule(tf.keras.Model):
 class RetinaFace(tf.keras.Model):
     """RetinaFace - https://arxiv.org/abs/1905.00641"""
 
-    def __init__(self, fpn, num_class=2, anchor_per_scale=3):
+    def __init__(self, fpn, num_class=2, anchor_per_scale=3, compute_dtype=tf.float32):
+        """
+        :param compute_dtype: dtype the backbone and heads run in, see common/precision.py, outputs are float32
+        """
         super(RetinaFace, self).__init__()
+        self.compute_dtype = compute_dtype
         self.num_class = num_class
         self.fpn = fpn()
         self.cm = [ContextModule() for _ in range(5)]
         self.cls_conv = [tf.keras.layers.Conv2D(num_class * anchor_per_scale, (3, 3), padding='same') for _ in range(5)]
         self.box_conv = [tf.keras.layers.Conv2D(4 * anchor_per_scale, (3, 3), padding='same') for _ in range(5)]
         self.lmk_conv = [tf.keras.layers.Conv2D(10 * anchor_per_scale, (3, 3), padding='same') for _ in range(5)]
-        self.softmax = tf.keras.layers.Softmax()
+        self.softmax = tf.keras.layers.Softmax(dtype='float32')
+
+    def fuse(self):
+        """
+            fold the backbone batch norms into its convs, inference only, see ResNet_v1.fuse
+        """
+        self.fpn.fuse()
+        return self
 
     def call(self, inputs, training=False, mask=None):
+        inputs = tf.cast(inputs, self.compute_dtype)
         features = self.fpn(inputs, training=training)
         x = [self.cm[i](features[i]) for i in range(len(features))]
         cls = [self.cls_conv[i](x[i]) for i in range(len(features))]
         box = [self.box_conv[i](x[i]) for i in range(len(features))]
         lmk = [self.lmk_conv[i](x[i]) for i in range(len(features))]
+        # softmax, anchor decoding and losses in float32
+        cls = [tf.cast(c, tf.float32) for c in cls]
+        box = [tf.cast(b, tf.float32) for b in box]
+        lmk = [tf.cast(m, tf.float32) for m in lmk]
 
         # no param part, for calc convenience
         cls = [tf.reshape(cls[i], (cls[i].shape[0], cls[i].shape[1], cls[i].shape[2], -1, self.num_class)) for i in
@@ -4,6 +4,7 @@ import argparse
 import sys
 
 import numpy as np
+import tensorflow as tf
 import yaml
 
 from retinaface.backbones.resnet_v1_fpn import ResNet_v1_50_FPN
@@ -33,6 +34,7 @@ def predict(model, images, au):
 def parse_args(argv):
     parser = argparse.ArgumentParser(description='Train face network')
     parser.add_argument('--config_path', type=str, help='path to config path', default='configs/config.yaml')
+    parser.add_argument('--fuse_bn', action='store_true', help='fold the backbone batch norms into the convs')
 
     args = parser.parse_args(argv)
 
@@ -49,6 +51,10 @@ def main():
     gd = GenerateData(config)
     train_data = gd.get_train_data()
     model = RetinaFace(ResNet_v1_50_FPN, num_class=2, anchor_per_scale=6)
+    if args.fuse_bn:
+        # build the variables, then fold
+        model(tf.zeros((1, config['image_size'], config['image_size'], 3)), training=False)
+        model.fuse()
     au = AnchorUtil(config)
     import cv2
     for img, label, path in train_data.take(1):
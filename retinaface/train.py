@@ -10,6 +10,10 @@ import time
 import tensorflow as tf
 import yaml
 
+from common.checkpoint import PreemptionFlag
+from common.precision import LossScale, set_policy
+from common.train_loop import GradientAccumulator, TrainLoop
+from common.train_metrics import TrainMetrics
 from retinaface.backbones.resnet_v1_fpn import ResNet_v1_50_FPN
 from retinaface.data.generate_data import GenerateData
 from retinaface.losses.loss import LossUtil
@@ -32,12 +36,21 @@ tf.enable_eager_execution()
 # logger = logging.getLogger("mylogger")
 
 class Trainer:
-    def __init__(self, config):
+    def __init__(self, config, benchmark=False):
+        """
+        :param benchmark: only build the model, optimizer and train data: no checkpoint restore,
+                          summary dirs or metrics thread, see benchmark.py
+        """
+        # mixed precision policy must be set before the model is built
+        self.precision = config.get('precision', 'float32')
+        compute_dtype = set_policy(self.precision)
+        self.loss_scale = LossScale() if self.precision == 'float16' else None
         self.gd = GenerateData(config)
         self.train_data = self.gd.get_train_data()
         # valid_data = self.gd.get_val_data(config['valid_num'])
         anchor_per_scale = len(config['base_anchors'][0]) * len(config['anchor_ratios'])
-        self.model = RetinaFace(ResNet_v1_50_FPN, num_class=config['num_class'], anchor_per_scale=anchor_per_scale)
+        self.model = RetinaFace(ResNet_v1_50_FPN, num_class=config['num_class'], anchor_per_scale=anchor_per_scale,
+                                compute_dtype=compute_dtype)
         self.au = AnchorUtil(config)
         self.lu = LossUtil(config)
         self.feat_strides = config['feat_strides']
@@ -69,16 +82,23 @@ class Trainer:
         else:
             raise ValueError('Invalid optimization algorithm')
 
-        ckpt_dir = os.path.expanduser(config['ckpt_dir'])
+        # the first call creates the model variables
+        self.model(tf.zeros((1, self.image_size, self.image_size, 3)), training=False)
+        # gradients of accum_steps micro batches are averaged into one optimizer step,
+        # the train step runs eagerly, so heads the loss leaves without a gradient for a window are not updated
+        self.accumulator = GradientAccumulator(self.optimizer, config.get('accum_steps', 1), self.loss_scale)
+        self.accumulator.build(self.model.trainable_variables)
 
-        self.ckpt = tf.train.Checkpoint(model=self.model, optimizer=self.optimizer)
-        self.ckpt_manager = tf.train.CheckpointManager(self.ckpt, ckpt_dir, max_to_keep=5, checkpoint_name='mymodel')
+        if not benchmark:
+            self._init_run(config)
 
-        if self.ckpt_manager.latest_checkpoint:
-            self.ckpt.restore(self.ckpt_manager.latest_checkpoint)
-            print("Restored from {}".format(self.ckpt_manager.latest_checkpoint))
-        else:
-            print("Initializing from scratch.")
+    def _init_run(self, config):
+        """
+            checkpoints (restored if there is one), validation, summaries and metrics of a training run
+        """
+        self.loop = TrainLoop({'model': self.model, 'optimizer': self.optimizer},
+                              os.path.expanduser(config['ckpt_dir']), self.accumulator, config.get('ckpt_steps', 0),
+                              config.get('ckpt_staging_dir'), config.get('ckpt_save_iterator', True))
 
         # self.vd = Valid_Data(self.model, valid_data)
 
@@ -95,6 +115,8 @@ class Trainer:
         # self.valid_summary_writer = tf.summary.create_file_writer(valid_log_dir)
         self.train_summary_writer = tf.compat.v2.summary.create_file_writer(train_log_dir)
         self.valid_summary_writer = tf.compat.v2.summary.create_file_writer(valid_log_dir)
+        self.metrics = TrainMetrics(['loss', 'cls_loss', 'box_loss', 'lmk_loss', 'pix_loss'], self.train_summary_writer,
+                                    config.get('metrics_flush_steps', 100))
 
     # @tf.function
     def _train_step(self, img, label):
@@ -104,49 +126,53 @@ class Trainer:
             lmks = self.au.decode_lmk(lmks)
             preds = [tf.concat((classes[i], boxes[i], lmks[i]), axis=-1) for i in range(len(classes))]
             loss, cls_loss, box_loss, lmk_loss, pix_losss = self.lu.cal_loss(preds, label)
-        gradients = tape.gradient(loss, self.model.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        # with float16 the loss is scaled up so small gradients survive, apply_gradients scales them back
+        output_gradients = self.loss_scale.scale if self.loss_scale is not None else None
+        gradients = tape.gradient(loss, self.model.trainable_variables, output_gradients=output_gradients)
+        self.accumulator.add(gradients)
 
         return loss, cls_loss, box_loss, lmk_loss, pix_losss
 
+    def epoch_data(self):
+        """
+        :return: dataset of this epoch, step_fn(*batch) -> tuple of the metrics,
+                 whether the saved iterator state belongs to the dataset
+        """
+        # batches are (image, label, path)
+        return self.train_data, lambda image, label, _: self._train_step(image, label), True
+
     def train(self):
-        for epoch in range(self.epoch_num):
-            start = time.time()
-
-            for step, (input_image, target, _) in enumerate(self.train_data):
-                loss, cls_loss, box_loss, lmk_loss, pix_losss = self._train_step(input_image, target)
-                with self.train_summary_writer.as_default():
-                    tf.compat.v2.summary.scalar('loss', loss, step=step)
-                    tf.compat.v2.summary.scalar('cls_loss', cls_loss, step=step)
-                    tf.compat.v2.summary.scalar('box_loss', box_loss, step=step)
-                    tf.compat.v2.summary.scalar('lmk_loss', lmk_loss, step=step)
-                    tf.compat.v2.summary.scalar('pix_losss', pix_losss, step=step)
-
-                print('epoch: {}, step: {}, loss = {}, cls_loss = {}, box_loss = {}, lmk_loss = {}, pix_loss = {}'
-                      .format(epoch, step, loss, cls_loss, box_loss, lmk_loss, pix_losss))
-
-            # valid
-            # acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr = self.vd.get_metric(self.thresh, self.below_fpr)
-
-            # with self.valid_summary_writer.as_default():
-            #     tf.compat.v2.summary.scalar('acc', acc, step=epoch)
-            #     tf.compat.v2.summary.scalar('p', p, step=epoch)
-            #     tf.compat.v2.summary.scalar('r=tpr', r, step=epoch)
-            #     tf.compat.v2.summary.scalar('fpr', fpr, step=epoch)
-            #     tf.compat.v2.summary.scalar('acc_fpr', acc_fpr, step=epoch)
-            #     tf.compat.v2.summary.scalar('p_fpr', p_fpr, step=epoch)
-            #     tf.compat.v2.summary.scalar('r=tpr_fpr', r_fpr, step=epoch)
-            #     tf.compat.v2.summary.scalar('thresh_fpr', thresh_fpr, step=epoch)
-            # print('epoch: {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, fpr: {:.3f} \n'
-            #       'fix fpr <= {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, thresh: {:.3f}'
-            #       .format(epoch, acc, p, r, fpr, self.below_fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr))
-
-            # ckpt
-            # if epoch % 5 == 0:
-            save_path = self.ckpt_manager.save()
-            print('Saving checkpoint for epoch {} at {}'.format(epoch, save_path))
-
-            print('Time taken for epoch {} is {} sec\n'.format(epoch, time.time() - start))
+        with PreemptionFlag() as preemption:
+            for epoch in self.loop.epochs(self.epoch_num):
+                start = time.time()
+                train_data, train_step, restore = self.epoch_data()
+                if self.loop.run_epoch(epoch, train_data, train_step, self.metrics, preemption, restore):
+                    break
+
+                # valid
+                # acc, p, r, fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr = self.vd.get_metric(self.thresh, self.below_fpr)
+
+                # with self.valid_summary_writer.as_default():
+                #     tf.compat.v2.summary.scalar('acc', acc, step=epoch)
+                #     tf.compat.v2.summary.scalar('p', p, step=epoch)
+                #     tf.compat.v2.summary.scalar('r=tpr', r, step=epoch)
+                #     tf.compat.v2.summary.scalar('fpr', fpr, step=epoch)
+                #     tf.compat.v2.summary.scalar('acc_fpr', acc_fpr, step=epoch)
+                #     tf.compat.v2.summary.scalar('p_fpr', p_fpr, step=epoch)
+                #     tf.compat.v2.summary.scalar('r=tpr_fpr', r_fpr, step=epoch)
+                #     tf.compat.v2.summary.scalar('thresh_fpr', thresh_fpr, step=epoch)
+                # print('epoch: {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, fpr: {:.3f} \n'
+                #       'fix fpr <= {}, acc: {:.3f}, p: {:.3f}, r=tpr: {:.3f}, thresh: {:.3f}'
+                #       .format(epoch, acc, p, r, fpr, self.below_fpr, acc_fpr, p_fpr, r_fpr, thresh_fpr))
+
+                # ckpt, at the start of the next epoch
+                # if epoch % 5 == 0:
+                save_path = self.loop.end_epoch(epoch)
+                print('Saving checkpoint for epoch {} at {}'.format(epoch, save_path))
+
+                print('Time taken for epoch {} is {} sec\n'.format(epoch, time.time() - start))
+        self.metrics.close(self.loop.step)
+        self.loop.close()
 
 
 def parse_args(argv):